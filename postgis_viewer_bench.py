@@ -0,0 +1,269 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Benchmark of postgis_viewer against a local PostGIS database.
+Usage: postgis_viewer_bench.py <options>
+       postgis_viewer_bench.py --compare old.json new.json
+
+Options:
+	-h host
+	-p port
+	-U user
+	-W password
+	-d database (a scratch one, the synthetic tables are created there)
+	-s schema of the synthetic tables (default postgis_viewer_bench)
+	--sizes=n,n,...		rows of the tables (default 10000,100000,1000000,10000000)
+	--kinds=k,k,...		point, line, polygon and/or raster (default all of them)
+	--output=file		write the results to file (default bench-<version>-<date>.json)
+	--rebuild		create the tables again even if they exist
+	--timeout=secs		abort a measurement after secs seconds (default 600)
+	--compare old new	compare two result files, exit with 1 if a case is over
+				20% (and 50 ms) slower in the new one
+
+The tables are point_<n>, line_<n>, polygon_<n> and raster_<n>, with a primary
+key, a spatial index and statistics; a raster of n rows has n/1000 tiles of
+100x100 pixels. Random values are seeded, so the tables are the same on every
+host. No viewer may be running for the user while the benchmark runs.
+
+Measured per table, in seconds:
+	startup			launcher start to the window shown (cold start)
+	detection		catalog query of main()
+	load layer		provider construction and extent of the layer
+	first frame		launcher start to the first frame with the layer drawn
+	navigation <step>	extent change to its frame, for a zoom and pan sequence
+	forward			run of a second instance forwarding the table to a daemon
+				(one acknowledging without loading, so that no render of
+				a previous table delays the acknowledgement)
+	ipc send		sending of that request and its acknowledgement
+"""
+
+import os, sys, time, getopt, json, platform, tempfile, subprocess
+
+try:
+	from PyQt4.QtCore import QCoreApplication
+	from PyQt4.QtSql import QSqlDatabase, QSqlQuery
+
+except ImportError:
+	print >> sys.stderr, 'E: Qt not installed.'
+	print >> sys.stderr, 'E: Exiting ...'
+	sys.exit(1)
+
+import postgis_viewer
+
+viewer = os.path.join( os.path.dirname( os.path.abspath( __file__ ) ), 'postgis_viewer.py' )
+
+kinds = [ 'point', 'line', 'polygon', 'raster' ]
+
+# Random points over the world, the source of the vector tables
+pointsSql = "( SELECT i, random() * 360 - 180 AS x, random() * 170 - 85 AS y \
+	FROM generate_series( 1, %(rows)d ) i ) s"
+
+tableSql = {
+	'point': "SELECT i AS id, ST_SetSRID( ST_MakePoint( x, y ), 4326 )::geometry(Point,4326) AS geom \
+		FROM " + pointsSql,
+	'line': "SELECT i AS id, ST_SetSRID( ST_MakeLine( ST_MakePoint( x, y ), \
+			ST_MakePoint( x + random() - 0.5, y + random() - 0.5 ) ), 4326 )::geometry(LineString,4326) AS geom \
+		FROM " + pointsSql,
+	'polygon': "SELECT i AS id, ST_Buffer( ST_SetSRID( ST_MakePoint( x, y ), 4326 ), 0.05, 2 )::geometry(Polygon,4326) AS geom \
+		FROM " + pointsSql,
+	'raster': "SELECT i AS id, ST_AddBand( ST_MakeEmptyRaster( 100, 100, ( i %% 360 ) - 180.0, 85.0 - ( i / 360 ), \
+			0.01, -0.01, 0, 0, 4326 ), '16BSI'::text, ( random() * 1000 )::integer, -32768 ) AS rast \
+		FROM generate_series( 0, %(rows)d - 1 ) i" }
+
+geometryColumns = { 'point': 'geom', 'line': 'geom', 'polygon': 'geom', 'raster': 'rast' }
+
+
+def connectionArgs( dictOpts ):
+	args = []
+	for opt in [ '-h', '-p', '-U', '-W', '-d' ]:
+		if dictOpts[ opt ]:
+			args += [ opt, dictOpts[ opt ] ]
+	return args
+
+def execute( d, sql ):
+	query = QSqlQuery( d )
+	if not query.exec_( sql ):
+		raise Exception( 'Query failed: %s\n%s' % ( query.lastError().text(), sql ) )
+	return query
+
+def tableExists( d, schema, table ):
+	return execute( d, "SELECT 1 FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace \
+		WHERE n.nspname = '%s' AND c.relname = '%s'" % ( schema, table ) ).next()
+
+def createTable( d, schema, kind, size, rebuild ):
+	""" Create a synthetic table unless it exists, return its name """
+	table = '%s_%d' % ( kind, size )
+	if tableExists( d, schema, table ):
+		if not rebuild:
+			return table
+		execute( d, 'DROP TABLE "%s"."%s"' % ( schema, table ) )
+
+	print 'I: Creating %s.%s ...' % ( schema, table )
+	rows = size
+	if kind == 'raster':
+		rows = max( 1, size / 1000 )
+	column = geometryColumns[ kind ]
+	execute( d, "SELECT setseed( 0.5 )" ) # The same tables on every host
+	execute( d, 'CREATE TABLE "%s"."%s" AS %s' % ( schema, table, tableSql[ kind ] % { 'rows': rows } ) )
+	execute( d, 'ALTER TABLE "%s"."%s" ADD PRIMARY KEY ( id )' % ( schema, table ) )
+	if kind == 'raster':
+		execute( d, "SELECT AddRasterConstraints( '%s'::name, '%s'::name, 'rast'::name )" % ( schema, table ) )
+		execute( d, 'CREATE INDEX "%s_idx" ON "%s"."%s" USING gist ( ST_ConvexHull( rast ) )' % ( table, schema, table ) )
+	else:
+		execute( d, 'CREATE INDEX "%s_idx" ON "%s"."%s" USING gist ( %s )' % ( table, schema, table, column ) )
+	execute( d, 'ANALYZE "%s"."%s"' % ( schema, table ) )
+	return table
+
+def setUp( dictOpts, sizes, tableKinds, rebuild ):
+	""" Create the schema and the tables, return the ( kind, size, table ) to measure """
+	app = QCoreApplication( sys.argv ) # Needed by the SQL drivers
+	d = QSqlDatabase.addDatabase( "QPSQL", "bench" )
+	d.setHostName( dictOpts['-h'] )
+	d.setPort( int( dictOpts['-p'] ) )
+	d.setDatabaseName( dictOpts['-d'] )
+	d.setUserName( dictOpts['-U'] )
+	d.setPassword( dictOpts['-W'] )
+	if not d.open():
+		raise Exception( 'Connection failed: %s' % d.lastError().text() )
+
+	schema = dictOpts['-s']
+	if not execute( d, "SELECT 1 FROM pg_namespace WHERE nspname = '%s'" % schema ).next():
+		execute( d, 'CREATE SCHEMA "%s"' % schema )
+	tables = []
+	for kind in tableKinds:
+		for size in sizes:
+			tables.append( ( kind, size, createTable( d, schema, kind, size, rebuild ) ) )
+	postgis = ''
+	query = execute( d, "SELECT postgis_lib_version()" )
+	if query.next():
+		postgis = str( query.value( 0 ).toString() )
+	d.close()
+	return tables, postgis
+
+def run( args, timeout ):
+	""" Run the launcher with args, return its start time and duration """
+	start = time.time()
+	process = subprocess.Popen( [ sys.executable, viewer ] + args )
+	while process.poll() is None:
+		if time.time() - start > timeout:
+			process.kill()
+			raise Exception( 'Timeout: %s' % ' '.join( args ) )
+		time.sleep( 0.01 )
+	if process.returncode != 0:
+		raise Exception( 'Exit code %d: %s' % ( process.returncode, ' '.join( args ) ) )
+	return start, time.time() - start
+
+def readRecords( fileName ):
+	""" Return the JSON lines of a file and empty it """
+	if not os.path.exists( fileName ):
+		return []
+	f = open( fileName )
+	records = [ json.loads( line ) for line in f if line.strip() ]
+	f.close()
+	os.remove( fileName )
+	return records
+
+def phaseTime( records, phase ):
+	return sum( [ record['seconds'] for record in records if record['phase'] == phase ] )
+
+def measure( dictOpts, tables, timeout ):
+	""" Measure every table, return the result records """
+	tmpDir = tempfile.mkdtemp()
+	profileFile = os.path.join( tmpDir, 'profile.json' )
+	startupFile = os.path.join( tmpDir, 'startup.json' )
+	results = []
+
+	def add( case, kind, size, table, seconds ):
+		print 'I: %-20s %-20s %8.3f s' % ( case, table, seconds )
+		results.append( { 'case': case, 'kind': kind, 'size': size, 'table': table, 'seconds': seconds } )
+
+	for kind, size, table in tables: # Cold starts
+		start, seconds = run( connectionArgs( dictOpts ) + [ '-s', dictOpts['-s'], '-t', table, '--benchmark',
+			'--profile-file=' + profileFile, '--startup-report=' + startupFile ], timeout )
+		startup = readRecords( startupFile )
+		if not startup or startup[ 0 ]['mode'] != 'viewer':
+			raise Exception( 'A viewer is already running, stop it before the benchmark' )
+		records = readRecords( profileFile )
+		add( 'startup', kind, size, table, startup[ 0 ]['total'] )
+		add( 'detection', kind, size, table, phaseTime( records, 'catalog' ) )
+		add( 'load layer', kind, size, table, phaseTime( records, 'provider' ) + phaseTime( records, 'extent' ) )
+		for record in records:
+			if record['phase'] == 'first frame':
+				add( 'first frame', kind, size, table, record['time'] - start )
+			elif record['phase'] == 'navigation':
+				add( 'navigation ' + record['step'], kind, size, table, record['seconds'] )
+
+	# Second instances forwarding to a running daemon, idle for every forward
+	daemon = subprocess.Popen( [ sys.executable, viewer ] + connectionArgs( dictOpts ) +
+		[ '--daemon', '--benchmark', '--idle-timeout=%d' % timeout, '--startup-report=' + startupFile ] )
+	try:
+		start = time.time()
+		while not readRecords( startupFile ): # Written once the daemon listens
+			if time.time() - start > timeout or daemon.poll() is not None:
+				raise Exception( 'The daemon did not start' )
+			time.sleep( 0.1 )
+		for kind, size, table in tables:
+			start, seconds = run( connectionArgs( dictOpts ) + [ '-s', dictOpts['-s'], '-t', table,
+				'--profile-file=' + profileFile ], timeout )
+			add( 'forward', kind, size, table, seconds )
+			add( 'ipc send', kind, size, table, phaseTime( readRecords( profileFile ), 'ipc send' ) )
+	finally:
+		daemon.terminate()
+		daemon.wait()
+	return results
+
+def compare( oldFile, newFile, threshold=1.2, noise=0.05 ):
+	""" Print the cases of two result files side by side, return the number of regressions """
+	old = json.load( open( oldFile ) )
+	new = json.load( open( newFile ) )
+	oldTimes = dict( [ ( ( r['case'], r['table'] ), r['seconds'] ) for r in old['results'] ] )
+	print 'I: %s (%s) -> %s (%s)' % ( old['version'], old['date'], new['version'], new['date'] )
+	regressions = 0
+	for r in new['results']:
+		key = ( r['case'], r['table'] )
+		if not key in oldTimes:
+			continue
+		before = oldTimes[ key ]
+		flag = ''
+		if r['seconds'] > before * threshold and r['seconds'] - before > noise:
+			flag = 'REGRESSION'
+			regressions += 1
+		ratio = before and r['seconds'] / before or 0
+		print '%-20s %-20s %8.3f %8.3f %6.2fx %s' % ( r['case'], r['table'], before, r['seconds'], ratio, flag )
+	return regressions
+
+def main( argv ):
+	dictOpts = { '-h':'', '-p':'5432', '-U':'', '-W':'', '-d':'', '-s':'postgis_viewer_bench',
+				  '--sizes':'10000,100000,1000000,10000000', '--kinds':','.join( kinds ),
+				  '--output':'', '--timeout':'600' }
+
+	opts, args = getopt.getopt( argv[1:], 'h:p:U:W:d:s:',
+		[ 'sizes=', 'kinds=', 'output=', 'rebuild', 'timeout=', 'compare' ] )
+	dictOpts.update( opts )
+
+	if '--compare' in dictOpts:
+		if len( args ) != 2:
+			print __doc__
+			sys.exit( 1 )
+		sys.exit( compare( args[ 0 ], args[ 1 ] ) and 1 or 0 )
+
+	if dictOpts['-d'] == '':
+		print >> sys.stderr, 'E: Database is required'
+		print __doc__
+		sys.exit( 1 )
+
+	sizes = [ int( size ) for size in dictOpts['--sizes'].split( ',' ) ]
+	tableKinds = dictOpts['--kinds'].split( ',' )
+	tables, postgis = setUp( dictOpts, sizes, tableKinds, '--rebuild' in dictOpts )
+	results = measure( dictOpts, tables, int( dictOpts['--timeout'] ) )
+
+	date = time.strftime( '%Y-%m-%dT%H:%M:%S' )
+	output = dictOpts['--output'] or 'bench-%s-%s.json' % ( postgis_viewer.__version__, date.replace( ':', '' ) )
+	f = open( output, 'w' )
+	json.dump( { 'version': postgis_viewer.__version__, 'date': date, 'host': platform.node(),
+		'python': platform.python_version(), 'postgis': postgis, 'results': results }, f, indent=1, sort_keys=True )
+	f.close()
+	print 'I: Results written to %s' % output
+
+if __name__ == "__main__":
+	main( sys.argv )
@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+"""
+On-disk caches of postgis_viewer. Entries are files in a directory, named by
+the hash of their key, and the directory is kept below a size limit by
+evicting the least recently used files. It needs neither Qt nor QGIS.
+"""
+
+import os, time, hashlib
+import thread, threading
+
+def cacheDirectory( name ):
+	""" Return the directory of a named cache in the user cache directory """
+	base = os.environ.get( 'XDG_CACHE_HOME' ) or os.path.expanduser( '~/.cache' )
+	return os.path.join( base, 'postgis_viewer', name )
+
+
+class DiskCache:
+	""" Files of a directory bounded to maxSize bytes, safe to use from several threads """
+	def __init__( self, directory, maxSize ):
+		self.directory = directory
+		self.maxSize = maxSize
+		self.lock = threading.Lock()
+		self.entries = None # File name -> [ size, last use ], scanned on the first use
+		self.size = 0
+
+	def fileName( self, key ):
+		return hashlib.sha1( key ).hexdigest()
+
+	def scan( self ):
+		""" Index the files left by the previous runs, called with the lock held """
+		if self.entries is not None:
+			return
+		self.entries = {}
+		if not os.path.isdir( self.directory ):
+			os.makedirs( self.directory )
+		for name in os.listdir( self.directory ):
+			path = os.path.join( self.directory, name )
+			if name.endswith( '.tmp' ): # Left by an interrupted write
+				os.remove( path )
+				continue
+			st = os.stat( path )
+			self.entries[ name ] = [ st.st_size, st.st_atime ]
+			self.size += st.st_size
+
+	def path( self, key ):
+		""" Return the path of a cached entry and mark it as used, None if it is not cached """
+		name = self.fileName( key )
+		self.lock.acquire()
+		try:
+			self.scan()
+			if not name in self.entries:
+				return None
+			now = time.time()
+			self.entries[ name ][ 1 ] = now
+			path = os.path.join( self.directory, name )
+			os.utime( path, ( now, now ) ) # The order survives a restart
+			return path
+		finally:
+			self.lock.release()
+
+	def get( self, key ):
+		""" Return the cached data of a key, None if it is not cached """
+		path = self.path( key )
+		if path is None:
+			return None
+		try:
+			f = open( path, 'rb' )
+			try:
+				return f.read()
+			finally:
+				f.close()
+		except IOError: # Evicted meanwhile
+			return None
+
+	def put( self, key, data ):
+		""" Store data for a key, evicting the least recently used entries if needed """
+		tmpPath = self.tempPath( key )
+		f = open( tmpPath, 'wb' )
+		try:
+			f.write( data )
+		finally:
+			f.close()
+		self.add( key, tmpPath )
+
+	def tempPath( self, key ):
+		""" Return a path in the cache directory to write an entry before adding it """
+		self.lock.acquire()
+		try:
+			self.scan()
+		finally:
+			self.lock.release()
+		return os.path.join( self.directory, '%s.%d.tmp' % ( self.fileName( key ), thread.get_ident() ) )
+
+	def add( self, key, tmpPath ):
+		""" Move a written file (see tempPath) into the cache as the entry of a key """
+		name = self.fileName( key )
+		size = os.path.getsize( tmpPath )
+		self.lock.acquire()
+		try:
+			self.scan()
+			path = os.path.join( self.directory, name )
+			if os.name == "nt" and os.path.exists( path ): # No replacing rename on Windows
+				os.remove( path )
+			os.rename( tmpPath, path ) # Atomic for the readers
+			if name in self.entries:
+				self.size -= self.entries[ name ][ 0 ]
+			self.entries[ name ] = [ size, time.time() ]
+			self.size += size
+			self.evict()
+		finally:
+			self.lock.release()
+
+	def evict( self ):
+		""" Remove the least recently used entries over the limit, called with the lock held """
+		if self.size <= self.maxSize:
+			return
+		for name in sorted( self.entries, key=lambda name: self.entries[ name ][ 1 ] ):
+			try:
+				os.remove( os.path.join( self.directory, name ) )
+			except OSError:
+				pass
+			self.size -= self.entries.pop( name )[ 0 ]
+			if self.size <= self.maxSize:
+				break
@@ -0,0 +1,2579 @@
+# -*- coding: utf-8 -*-
+"""
+Viewer window, layer legend and the QGIS side of postgis_viewer. Loading this
+module loads QtGui and the QGIS libraries, so the launcher imports it only when
+a window is actually created.
+"""
+
+import os, sys, math, time
+import thread, threading
+import base64, struct, hashlib
+import collections
+
+try:
+	from PyQt4.QtSql import QSqlDatabase, QSqlQuery
+	from PyQt4.QtGui import ( QAction, QMainWindow, QApplication, QMessageBox, 
+		QStatusBar, QFrame, QLabel, QDockWidget, QTreeWidget, QTreeWidgetItem, 
+		QPixmap, QIcon, QFont, QMenu, QColorDialog, QImage, QPainter )
+	from PyQt4.QtCore import ( SIGNAL, Qt, QString, QSharedMemory, QPoint, QTimer,
+		QObject, QRunnable, QThreadPool, QSettings, QByteArray, QBuffer, QIODevice )
+
+	from qgis.core import ( QgsApplication, QgsDataSourceURI, QgsVectorLayer, QgsRasterLayer,
+		QgsMapLayerRegistry, QgsRectangle, QgsFeature, QgsGeometry )
+	from qgis.gui import QgsMapCanvas, QgsMapToolPan, QgsMapToolZoom, QgsMapCanvasLayer
+
+except ImportError:
+	print >> sys.stderr, 'E: Qt or QGIS not installed.'
+	print >> sys.stderr, 'E: Exiting ...'
+	sys.exit(1)
+
+try:
+	from osgeo import gdal # Optional, only needed to cache rasters locally
+except ImportError:
+	gdal = None
+
+import postgis_viewer_ipc
+import postgis_viewer_cache
+import postgis_viewer_profile
+from postgis_viewer_profile import timed
+
+# Set the qgis_prefix and the imgs_dir according to the current os
+qgis_prefix = ""
+imgs_dir = ""
+if os.name == "nt": # Windows
+	qgis_prefix = "C:/OSGeo4W/apps/qgis/"
+	imgs_dir = "images/"
+else: # Linux
+	qgis_prefix = "/usr"
+	imgs_dir = "images/"
+
+# Number of threads detecting and building layers concurrently
+max_load_workers = 4
+
+# Milliseconds during which redraw requests are merged into a single render
+refresh_delay = 40
+
+# Level of detail (--lod): lines and polygons are simplified on the server in
+# lod_bands scale bands, each lod_band_factor times finer than the previous one.
+# The coarsest band is simplified to a pixel of the layer extent drawn on
+# lod_base_pixels pixels, zooming in past the finest band draws the full detail
+lod_bands = 4
+lod_band_factor = 4
+lod_base_pixels = 1024
+# With --lod-tables the simplified geometries of a band are computed once into
+# an unlogged table with a spatial index in this schema, per table version
+# (views are simplified at every draw, as every band without the option)
+lod_schema = 'postgis_viewer_cache'
+
+# Tile mode (--tiles): vector layers are fetched by square tiles of about
+# tile_pixels pixels on a grid anchored at the map origin, simplified to a
+# pixel, and kept in an on-disk cache bounded to tile_cache_size bytes
+tile_pixels = 256
+tile_cache_size = 256 * 1024 * 1024
+tileCache = postgis_viewer_cache.DiskCache( postgis_viewer_cache.cacheDirectory( 'tiles' ),
+	tile_cache_size )
+
+# While panning, the ring of tiles around the view is prefetched behind the
+# visible ones, prefetch_ahead more tiles in the direction of the recent pans.
+# Prefetched tiles are kept in memory, at most prefetch_cache_tiles per level,
+# until they come into view
+prefetch_ahead = 1
+prefetch_cache_tiles = 64
+
+# Raster cache (--cache-rasters, needs the GDAL Python bindings): a raster is
+# copied once to a local tiled GeoTIFF with overviews and then drawn from it.
+# The copies are kept in an on-disk cache bounded to raster_cache_size bytes
+# and are read through memory mapping
+raster_cache_size = 2 * 1024 * 1024 * 1024
+rasterCache = postgis_viewer_cache.DiskCache( postgis_viewer_cache.cacheDirectory( 'rasters' ),
+	raster_cache_size )
+os.environ.setdefault( 'GTIFF_VIRTUAL_MEM_IO', 'IF_ENOUGH_RAM' ) # Read before QGIS loads GDAL
+
+# Legend thumbnails of rasters are rendered in the background and kept in an
+# on-disk cache bounded to thumbnail_cache_size bytes
+thumbnail_size = 20
+thumbnail_cache_size = 16 * 1024 * 1024
+thumbnailCache = postgis_viewer_cache.DiskCache( postgis_viewer_cache.cacheDirectory( 'thumbnails' ),
+	thumbnail_cache_size )
+
+# Preview (--preview): a vector layer of more than preview_min_rows estimated
+# rows is drawn first from a server side sample of about preview_rows rows,
+# then in full once the sample is drawn, again at every view change
+preview_min_rows = 1000000
+preview_rows = 100000
+
+# Features of a layer are counted exactly in the background when the
+# estimated number of rows is below this limit, otherwise (or if the number
+# is unknown) only on demand
+exact_count_limit = 100000
+
+class SingletonApp(QApplication):
+	
+	def __init__(self, argv, application_id=None):
+		QApplication.__init__(self, argv)
+		
+		self.socket_filename = postgis_viewer_ipc.socket_filename()
+		self.shared_mem = QSharedMemory()
+		self.shared_mem.setKey(self.socket_filename)
+
+		if self.shared_mem.attach():
+			self.is_running = True
+			return
+		
+		self.is_running = False
+		if not self.shared_mem.create(1):
+			print >>sys.stderr, "Unable to create single instance"
+			return
+		# start local server
+		self.server = postgis_viewer_ipc.MessageServer(self)
+		# connect signal for incoming requests
+		self.connect(self.server, SIGNAL("requestReceived"), self.handle_new_message)
+		# listen
+		self.server.listen(self.socket_filename)
+
+	def __del__(self):
+		self.shared_mem.detach()
+		if not self.is_running:
+			if os.path.exists(self.socket_filename):
+				os.remove(self.socket_filename)
+
+
+	def send_message(self, message):
+		if not self.is_running:
+			raise Exception("Client cannot connect to IPC server. Not running.")
+		postgis_viewer_ipc.send_message(message)
+
+	def handle_new_message(self, message):
+		self.emit( SIGNAL("loadPgLayer"), message )
+
+
+class ViewerWnd( QMainWindow ):
+	def __init__( self, app, layers=[] ):
+		QMainWindow.__init__( self )
+
+		self.idleTimer = None # Only set in daemon mode
+		self.acknowledgeOnly = False # Benchmark daemon: requests are received, not loaded
+
+		self.canvas = QgsMapCanvas()
+		self.canvas.setCanvasColor( Qt.white )
+		self.canvas.useImageToRender( True )
+		self.canvas.enableAntiAliasing( True )
+		self.setCentralWidget( self.canvas )
+		self.refresher = RefreshScheduler( self.canvas, refresh_delay )
+
+		actionZoomIn = QAction( QIcon( imgs_dir + "mActionZoomIn.png" ), QString( "Zoom in" ), self )
+		actionZoomOut = QAction( QIcon( imgs_dir + "mActionZoomOut.png" ), QString( "Zoom out" ), self )
+		actionPan = QAction( QIcon( imgs_dir + "mActionPan.png" ), QString( "Pan" ), self )
+
+		actionZoomIn.setCheckable( True )
+		actionZoomOut.setCheckable( True )
+		actionPan.setCheckable( True )
+
+		self.connect(actionZoomIn, SIGNAL( "triggered()" ), self.zoomIn )
+		self.connect(actionZoomOut, SIGNAL( "triggered()" ), self.zoomOut )
+		self.connect(actionPan, SIGNAL( "triggered()" ), self.pan )
+
+		# Create the toolbar
+		self.toolbar = self.addToolBar( "Map tools" )
+		self.toolbar.addAction( actionZoomIn )
+		self.toolbar.addAction( actionZoomOut )
+		self.toolbar.addAction( actionPan )
+
+		# Create the map tools
+		self.toolPan = QgsMapToolPan( self.canvas )
+		self.toolPan.setAction( actionPan )
+		self.toolZoomIn = QgsMapToolZoom( self.canvas, False ) # false = in
+		self.toolZoomIn.setAction( actionZoomIn )
+		self.toolZoomOut = QgsMapToolZoom( self.canvas, True ) # true = out
+		self.toolZoomOut.setAction( actionZoomOut )
+		
+		# Create the statusbar
+		self.statusbar = QStatusBar( self )
+		self.statusbar.setObjectName( "statusbar" )
+		self.setStatusBar( self.statusbar )
+
+		self.lblXY = QLabel()
+		self.lblXY.setFrameStyle( QFrame.Box )
+		self.lblXY.setMinimumWidth( 170 )
+		self.lblXY.setAlignment( Qt.AlignCenter )
+		self.statusbar.setSizeGripEnabled( False )
+		self.statusbar.addPermanentWidget( self.lblXY, 0 )
+
+		self.lblScale = QLabel()
+		self.lblScale.setFrameStyle( QFrame.StyledPanel )
+		self.lblScale.setMinimumWidth( 140 )
+		self.statusbar.addPermanentWidget( self.lblScale, 0 )
+
+		self.createLegendWidget()	# Create the legend widget
+
+		self.loader = LayerLoader( self, max_load_workers )
+		self.connect( self.loader, SIGNAL( "layerLoaded" ), self.addLoadedLayer )
+		self.connect( self.loader, SIGNAL( "layerFailed" ), self.layerFailed )
+		self.connect( self.loader, SIGNAL( "taskQueued" ), self.legend.addPendingItem )
+		self.connect( self.loader, SIGNAL( "taskFinished" ), self.legend.removePendingItem )
+		self.connect( self.loader, SIGNAL( "taskCancelled" ), self.legend.removePendingItem )
+		self.connect( QgsMapLayerRegistry.instance(), SIGNAL( "layerWillBeRemoved(QString)" ),
+			self.forgetLayer )
+		self.connect( QgsMapLayerRegistry.instance(), SIGNAL( "removedAll()" ),
+			self.forgetAllLayers )
+		self.layerOpts = {} # Options of the loaded layers by layer id
+		self.layerInfo = {} # Metadata, extent and count of the loaded layers by layer id, kept with them
+		self.lodLayers = {} # Generalized versions of the loaded layers by layer id
+		self.tileSets = {} # Tiles of the layers loaded in tile mode by layer id
+		self.lastCenter = None # Center and map units per pixel of the previous view
+		self.panDirection = ( 0, 0 ) # Sign of the last pan along x and y
+		self.rasterCopies = {} # Local copies of the rasters drawn from the database by layer id
+		self.previews = {} # Samples of the huge layers drawn first (--preview) by layer id
+
+		self.connect( app, SIGNAL( "loadPgLayer" ), self.loadLayer )
+		self.connect( self.canvas, SIGNAL( "scaleChanged(double)" ),
+			self.changeScale )
+		self.connect( self.canvas, SIGNAL( "scaleChanged(double)" ),
+			self.scheduleLevelsOfDetail )
+		self.connect( self.canvas, SIGNAL( "extentsChanged()" ),
+			self.scheduleTiles )
+		self.connect( self.canvas, SIGNAL( "extentsChanged()" ),
+			self.resetPreviews )
+		self.connect( self.canvas, SIGNAL( "mapCanvasRefreshed()" ),
+			self.scheduleRefinement )
+		self.connect( self.canvas, SIGNAL( "xyCoordinates(const QgsPoint&)" ),
+			self.updateXY )
+
+		self.pan()
+
+		for dictOpts in layers:
+			self.loadLayer( dictOpts )
+
+	def setDaemonMode( self, idleTimeout, acknowledgeOnly=False ):
+		""" Keep the window (and QGIS) alive when closed, exit after idleTimeout seconds hidden.
+			With acknowledgeOnly the requests are not loaded (IPC benchmark) """
+		self.acknowledgeOnly = acknowledgeOnly
+		self.idleTimer = QTimer( self )
+		self.idleTimer.setSingleShot( True )
+		self.idleTimer.setInterval( idleTimeout * 1000 )
+		self.connect( self.idleTimer, SIGNAL( "timeout()" ), self.idleTimeout )
+		self.idleTimer.start()
+
+	def idleTimeout( self ):
+		print 'I: Daemon idle timeout reached'
+		QApplication.instance().quit()
+
+	def closeEvent( self, event ):
+		if self.idleTimer is None:
+			QMainWindow.closeEvent( self, event )
+			return
+		# Daemon mode: start from an empty map the next time and wait hidden
+		event.ignore()
+		self.hide()
+		self.loader.cancelAll() # Their layers would show up in the next session
+		QgsMapLayerRegistry.instance().removeAllMapLayers()
+		self.idleTimer.start()
+	
+	def zoomIn( self ):
+		self.canvas.setMapTool( self.toolZoomIn )
+
+	def zoomOut( self ):
+		self.canvas.setMapTool( self.toolZoomOut )
+
+	def pan( self ):
+		self.canvas.setMapTool( self.toolPan )
+
+	def createLegendWidget( self ):
+		""" Create the map legend widget and associate to the canvas """
+		self.legend = Legend( self )
+		self.legend.setCanvas( self.canvas )
+		self.legend.setObjectName( "theMapLegend" )
+
+		self.LegendDock = QDockWidget( "Layers", self )
+		self.LegendDock.setObjectName( "legend" )
+		#self.LegendDock.setAllowedAreas( Qt.LeftDockWidgetArea | Qt.RightDockWidgetArea )
+		self.LegendDock.setWidget( self.legend )
+		self.LegendDock.setContentsMargins ( 0, 0, 0, 0 )
+		self.addDockWidget( Qt.BottomDockWidgetArea, self.LegendDock )
+
+	def loadLayer( self, dictOpts ):
+		if self.acknowledgeOnly:
+			print 'I: Request for %s.%s received, not loaded' % ( dictOpts['-s'], dictOpts['-t'] )
+			return
+		print 'I: Loading the layer...'
+		if '--profile' in dictOpts: # Also asked by a forwarded request
+			postgis_viewer_profile.enable( dictOpts.get( '--profile-file', '' ) )
+		if self.idleTimer is not None:
+			self.idleTimer.stop()
+			self.show()
+
+		if not self.isActiveWindow():
+			self.activateWindow()			 
+			self.raise_() 
+
+		# Detection (for requests forwarded by a second instance) and layer
+		# construction run on the loader threads
+		self.loader.load( dictOpts )
+
+	def addLoadedLayer( self, taskId, dictOpts, layer, extent, lod, tiles, preview ):
+		""" Slot. Add a layer built (and validated) by the loader to the map """
+		if self.loader.isCancelled( taskId ): # Emitted just before the task was cancelled
+			print 'I: Loading of %s.%s cancelled' % ( dictOpts['-s'], dictOpts['-t'] )
+			return
+
+		# A single render once the layer and the versions replacing it are set,
+		# merged with the other layers loaded meanwhile
+		self.refresher.schedule()
+
+		if self.canvas.layerCount() == 0:
+			self.canvas.setExtent( extent )
+
+			if dictOpts[ 'srid' ] != '-1':
+				print 'I: Map SRS (EPSG): %s' % dictOpts[ 'srid' ]
+				self.canvas.setMapUnits( layer.srs().mapUnits() )
+			else:
+				print 'I: Unknown Reference System'
+				self.canvas.setMapUnits( 0 ) # 0: QGis.Meters
+
+		self.layerOpts[ unicode( layer.getLayerID() ) ] = dictOpts # Also used for the layer properties
+		# The detection cache expires, what the properties show is kept as long as the layer
+		info = dict( layerMetadataCache.get( dictOpts ) or {} )
+		info[ 'extent' ] = ( extent.xMinimum(), extent.yMinimum(), extent.xMaximum(), extent.yMaximum() )
+		self.layerInfo[ unicode( layer.getLayerID() ) ] = info
+		QgsMapLayerRegistry.instance().addMapLayer( layer )
+
+		if lod is not None:
+			self.lodLayers[ unicode( layer.getLayerID() ) ] = lod
+			for lodLayer in lod.layers.values():
+				self.registerVariantLayer( layer, lodLayer )
+			self.updateLevelsOfDetail()
+		if tiles is not None:
+			self.tileSets[ unicode( layer.getLayerID() ) ] = tiles
+			self.updateTiles()
+		if preview is not None:
+			self.previews[ unicode( layer.getLayerID() ) ] = preview
+			self.registerVariantLayer( layer, preview.layer )
+			if self.legend.setRenderLayer( unicode( layer.getLayerID() ), preview.layer ):
+				self.legend.updateLayerSet()
+			self.legend.layerItem( unicode( layer.getLayerID() ) ).setPartial( True )
+		if dictOpts['type'] == 'raster':
+			self.requestThumbnail( dictOpts, layer, lod )
+		if dictOpts['type'] == 'raster' and '--cache-rasters' in dictOpts and \
+			layer.source().startsWith( 'PG:' ) and gdal is not None: # Not cached yet
+			self.loader.runLong( lambda: createRasterCopy( dictOpts ), self.rasterCopyReady,
+				unicode( layer.getLayerID() ) )
+
+		if dictOpts['type'] == 'vector' and 0 <= info.get( 'estimatedRows', -1 ) < exact_count_limit:
+			self.countFeatures( layer ) # Unknown sizes are only counted on demand
+
+	def requestThumbnail( self, dictOpts, layer, overviews ):
+		""" Render the legend thumbnail of a raster in the background, from its
+			coarsest overview if it has overview tables """
+		source = unicode( layer.source() )
+		if overviews is not None:
+			factor, schema, table = overviews.overviews[ 0 ]
+			source = rasterConnString( dict( dictOpts, **{ '-s': schema, '-t': table } ) )
+		self.loader.run( lambda: rasterThumbnail( dictOpts, source ), self.thumbnailReady,
+			unicode( layer.getLayerID() ) )
+
+	def thumbnailReady( self, image, layerId ):
+		item = self.legend.layerItem( layerId )
+		if image is not None and item is not None:
+			item.setThumbnail( QPixmap.fromImage( image ) )
+
+	def countFeatures( self, layer ):
+		""" Count the features of a vector layer in the background and show the count """
+		dictOpts = self.layerOpts.get( unicode( layer.getLayerID() ) )
+		if dictOpts is None:
+			return
+		self.loader.run( lambda: exactCount( openConnection( dictOpts ), dictOpts ),
+			self.featureCountReady, dictOpts, unicode( layer.getLayerID() ) )
+
+	def featureCountReady( self, count, dictOpts, layerId ):
+		if count is None:
+			print >> sys.stderr, 'E: Features of %s.%s could not be counted' % ( dictOpts['-s'], dictOpts['-t'] )
+			return
+		if not layerId in self.layerInfo: # Removed meanwhile
+			return
+		self.layerInfo[ layerId ][ 'featureCount' ] = count
+		self.legend.updateLayerProperties( layerId )
+
+	def forgetLayer( self, layerId ):
+		""" Slot. Drop the options and the generalized versions of a removed layer """
+		self.layerOpts.pop( unicode( layerId ), None )
+		self.layerInfo.pop( unicode( layerId ), None )
+		variants = self.variantLayers( layerId )
+		self.lodLayers.pop( unicode( layerId ), None )
+		self.tileSets.pop( unicode( layerId ), None )
+		self.rasterCopies.pop( unicode( layerId ), None )
+		self.previews.pop( unicode( layerId ), None )
+		for variant in variants:
+			QgsMapLayerRegistry.instance().removeMapLayer( variant.getLayerID() )
+
+	def forgetAllLayers( self ):
+		""" Slot. The registry removed every layer """
+		self.layerOpts.clear()
+		self.layerInfo.clear()
+		self.lodLayers.clear()
+		self.tileSets.clear()
+		self.rasterCopies.clear()
+		self.previews.clear()
+
+	def variantLayers( self, layerId ):
+		""" Return the layers drawn instead of a layer at some scales """
+		variants = []
+		lod = self.lodLayers.get( unicode( layerId ) )
+		if lod is not None:
+			variants.extend( lod.layers.values() )
+		tiles = self.tileSets.get( unicode( layerId ) )
+		if tiles is not None:
+			variants.extend( tiles.layers() )
+		if unicode( layerId ) in self.rasterCopies:
+			variants.append( self.rasterCopies[ unicode( layerId ) ] )
+		if unicode( layerId ) in self.previews:
+			variants.append( self.previews[ unicode( layerId ) ].layer )
+		return variants
+
+	def registerVariantLayer( self, layer, variant ):
+		""" Make a layer drawn instead of another one look like it """
+		if isinstance( variant, QgsVectorLayer ):
+			copySymbology( layer, variant )
+		QgsMapLayerRegistry.instance().addMapLayer( variant, False ) # Not shown in the legend
+
+	def scheduleLevelsOfDetail( self, scale ):
+		""" Slot. Switch the bands once the canvas is done with the scale change """
+		if self.lodLayers:
+			QTimer.singleShot( 0, self.updateLevelsOfDetail )
+
+	def updateLevelsOfDetail( self ):
+		""" Draw every layer with the generalized band (or raster overview) matching
+			the current scale. A band not built yet is built in the background,
+			meanwhile the current one is kept """
+		mapUnitsPerPixel = self.canvas.mapUnitsPerPixel()
+		changed = False
+		for layerId, lod in self.lodLayers.items():
+			band = lod.band( mapUnitsPerPixel )
+			if band is None or band in lod.failed:
+				lodLayer = None # Full detail
+			elif band in lod.layers:
+				lodLayer = lod.layers[ band ]
+			else:
+				if not band in lod.building:
+					lod.building.add( band )
+					self.loader.run( lambda lod=lod, band=band: lod.build( band ),
+						self.lodLayerReady, layerId, band )
+				continue
+			changed = self.legend.setRenderLayer( layerId, lodLayer ) or changed
+		if changed:
+			self.legend.updateLayerSet()
+
+	def lodLayerReady( self, lodLayer, layerId, band ):
+		lod = self.lodLayers.get( layerId )
+		if lod is None: # The layer was removed meanwhile
+			return
+		lod.building.discard( band )
+		if lodLayer is None:
+			lod.failed.add( band )
+		else:
+			lod.layers[ band ] = lodLayer
+			self.registerVariantLayer( QgsMapLayerRegistry.instance().mapLayer( layerId ), lodLayer )
+		self.updateLevelsOfDetail()
+
+	def rasterCopyReady( self, copy, layerId ):
+		""" Draw a raster from its local copy from now on """
+		if copy is None or not layerId in self.layerOpts: # Not cached, or layer removed meanwhile
+			return
+		# The copy has its own overviews
+		overviews = self.lodLayers.pop( layerId, None )
+		if overviews is not None:
+			for layer in overviews.layers.values():
+				QgsMapLayerRegistry.instance().removeMapLayer( layer.getLayerID() )
+		self.rasterCopies[ layerId ] = copy
+		self.registerVariantLayer( QgsMapLayerRegistry.instance().mapLayer( layerId ), copy )
+		if self.legend.setRenderLayer( layerId, copy ):
+			self.legend.updateLayerSet()
+
+	def scheduleTiles( self ):
+		""" Slot. Fetch the tiles of the new view once the canvas is done with it """
+		if self.tileSets:
+			QTimer.singleShot( 0, self.updateTiles )
+
+	def updateTiles( self ):
+		""" Fetch the missing tiles of the visible grid at the current scale. The
+			tiles of a new zoom level go to a new layer, drawn once they are all in
+			(the first one is drawn at once, in place of the provider layer) """
+		mapUnitsPerPixel = self.canvas.mapUnitsPerPixel()
+		if mapUnitsPerPixel <= 0: # No view yet
+			return
+		extent = self.canvas.extent()
+		self.updatePanDirection( extent, mapUnitsPerPixel )
+		for layerId, tiles in self.tileSets.items():
+			level = tiles.levelFor( mapUnitsPerPixel )
+			if tiles.loading is None or tiles.loading.level != level:
+				if tiles.loading is not None and tiles.loading is not tiles.drawn:
+					# Zoomed again before the previous level was complete
+					QgsMapLayerRegistry.instance().removeMapLayer( tiles.loading.layer.getLayerID() )
+				if tiles.drawn is not None and tiles.drawn.level == level:
+					tiles.loading = tiles.drawn
+				else:
+					tiles.loading = TileLevel( level, createTileLayer( tiles ) )
+					self.registerVariantLayer( QgsMapLayerRegistry.instance().mapLayer( layerId ),
+						tiles.loading.layer )
+					if tiles.drawn is None: # The provider layer is never drawn, the first level fills as its tiles arrive
+						self.showTileLevel( layerId, tiles )
+
+			tileLevel = tiles.loading
+			visible = tiles.addresses( extent, level )
+			for x, y in visible:
+				if not ( x, y ) in tileLevel.requested:
+					tileLevel.requested.add( ( x, y ) )
+					tileLevel.pending += 1
+					if ( x, y ) in tileLevel.prefetched:
+						self.tileReady( tileLevel.prefetched.pop( ( x, y ) ), layerId, tileLevel, ( x, y ) )
+					elif ( x, y ) in tileLevel.prefetching: # Added by tilePrefetched
+						tileLevel.wanted.add( ( x, y ) )
+					else:
+						self.loader.run( lambda tiles=tiles, level=level, x=x, y=y: fetchTile( tiles, level, x, y ),
+							self.tileReady, layerId, tileLevel, ( x, y ) )
+			if tileLevel.pending == 0 and tileLevel is not tiles.drawn:
+				self.showTileLevel( layerId, tiles )
+
+			for x, y in tiles.ringAddresses( extent, level, self.panDirection, visible ):
+				if not ( x, y ) in tileLevel.requested and not ( x, y ) in tileLevel.prefetched \
+						and not ( x, y ) in tileLevel.prefetching:
+					tileLevel.prefetching.add( ( x, y ) )
+					self.loader.prefetch( lambda tiles=tiles, tileLevel=tileLevel, x=x, y=y:
+						fetchTile( tiles, tileLevel.level, x, y ) if tiles.loading is tileLevel else None, # Skipped once zoomed
+						self.tilePrefetched, layerId, tileLevel, ( x, y ) )
+
+	def updatePanDirection( self, extent, mapUnitsPerPixel ):
+		""" Keep the direction of the last pan, forgotten on zoom """
+		center = ( extent.center().x(), extent.center().y() )
+		if self.lastCenter is None or self.lastCenter[ 1 ] != mapUnitsPerPixel:
+			self.panDirection = ( 0, 0 )
+		else:
+			dx = center[ 0 ] - self.lastCenter[ 0 ][ 0 ]
+			dy = center[ 1 ] - self.lastCenter[ 0 ][ 1 ]
+			if dx or dy:
+				self.panDirection = ( cmp( dx, 0 ), cmp( dy, 0 ) )
+		self.lastCenter = ( center, mapUnitsPerPixel )
+
+	def tilePrefetched( self, features, layerId, tileLevel, address ):
+		tileLevel.prefetching.discard( address )
+		if address in tileLevel.wanted: # Came into view meanwhile
+			tileLevel.wanted.discard( address )
+			self.tileReady( features, layerId, tileLevel, address )
+			return
+		if features is None or not layerId in self.tileSets:
+			return
+		tileLevel.prefetched[ address ] = features
+		while len( tileLevel.prefetched ) > prefetch_cache_tiles:
+			tileLevel.prefetched.popitem( last=False ) # Oldest first
+
+	def tileReady( self, features, layerId, tileLevel, address ):
+		tileLevel.pending -= 1
+		tiles = self.tileSets.get( layerId )
+		if tiles is None or not tileLevel in ( tiles.loading, tiles.drawn ): # Layer or level dropped
+			return
+		if features is None: # Failed, retried with the next view change
+			tileLevel.requested.discard( address )
+		else:
+			added = []
+			for key, feature in features:
+				if not key in tileLevel.keys: # Also fetched with a neighbouring tile
+					tileLevel.keys.add( key )
+					added.append( feature )
+			if added:
+				tileLevel.layer.dataProvider().addFeatures( added )
+				tileLevel.layer.updateExtents()
+				tileLevel.layer.setCacheImage( None )
+				if tileLevel is tiles.drawn:
+					self.refresher.schedule()
+
+		if tileLevel is tiles.loading and tileLevel is not tiles.drawn and tileLevel.pending == 0:
+			self.showTileLevel( layerId, tiles )
+
+	def showTileLevel( self, layerId, tiles ):
+		""" Draw the completely fetched loading level instead of the drawn one """
+		previous = tiles.drawn
+		tiles.drawn = tiles.loading
+		if self.legend.setRenderLayer( layerId, tiles.drawn.layer ):
+			self.legend.updateLayerSet()
+		if previous is not None:
+			QgsMapLayerRegistry.instance().removeMapLayer( previous.layer.getLayerID() )
+
+	def resetPreviews( self ):
+		""" Slot. Draw the samples first at a new view, stopping a refinement in progress """
+		changed = False
+		for layerId, preview in self.previews.items():
+			if preview.state != 'sample':
+				preview.state = 'sample'
+				changed = self.legend.setRenderLayer( layerId, preview.layer ) or changed
+				self.legend.layerItem( layerId ).setPartial( True )
+		if changed:
+			self.legend.updateLayerSet()
+
+	def scheduleRefinement( self ):
+		""" Slot. Refine the previews once the canvas is done with the render """
+		if self.previews:
+			QTimer.singleShot( 0, self.refinePreviews )
+
+	def refinePreviews( self ):
+		""" Draw the layers whose sample was drawn in full, and mark those drawn in full """
+		if self.refresher.isPending() or self.canvas.isDrawing(): # The render was stopped for a newer one
+			return
+		changed = False
+		for layerId, preview in self.previews.items():
+			if preview.state == 'refining':
+				preview.state = 'refined'
+				self.legend.layerItem( layerId ).setPartial( False )
+			elif preview.state == 'sample':
+				preview.state = 'refining'
+				changed = self.legend.setRenderLayer( layerId, None ) or changed
+		if changed:
+			self.legend.updateLayerSet()
+
+	def layerExtent( self, layer ):
+		""" Return the known (possibly estimated) extent of a layer, avoiding
+			a scan of the whole table """
+		info = self.layerInfo.get( unicode( layer.getLayerID() ) )
+		if info is not None and 'extent' in info:
+			return QgsRectangle( *info['extent'] )
+		return layer.extent()
+
+	def zoomToExactExtent( self, layer ):
+		""" Compute the exact extent of a vector layer in the background, then zoom to it """
+		dictOpts = self.layerOpts.get( unicode( layer.getLayerID() ) )
+		if dictOpts is None:
+			return
+		self.statusbar.showMessage( "Computing the extent of %s.%s ..." % ( dictOpts['-s'], dictOpts['-t'] ) )
+		self.loader.run( lambda: exactExtent( openConnection( dictOpts ), dictOpts ),
+			self.exactExtentReady, dictOpts, layer )
+
+	def exactExtentReady( self, extent, dictOpts, layer ):
+		self.statusbar.clearMessage()
+		if extent is None:
+			QMessageBox.warning( self, "Error when computing the extent",
+				"The extent of '%s.%s' could not be computed." % ( dictOpts['-s'], dictOpts['-t'] ) )
+			return
+		layerMetadataCache.update( dictOpts, extent=extent, extentEstimated=False )
+		info = self.layerInfo.get( unicode( layer.getLayerID() ) )
+		if info is not None:
+			info.update( extent=extent, extentEstimated=False )
+			self.legend.updateLayerProperties( unicode( layer.getLayerID() ) )
+		extent = QgsRectangle( *extent )
+		extent.scale( 1.05 )
+		self.refresher.schedule()
+		self.canvas.setExtent( extent )
+
+	def layerFailed( self, title, text ):
+		""" Slot. Report a layer the loader could not detect or build """
+		QMessageBox.warning( self, title, text )
+
+	def getLayerProperties( self, l ):
+		""" Create a layer-properties string (l:layer). Counts and extents are the
+			ones known for the layer (estimates unless the exact values were computed) """
+		print 'I: Generating layer properties...'
+		dictOpts = self.layerOpts.get( unicode( l.getLayerID() ), {} )
+		metadata = self.layerInfo.get( unicode( l.getLayerID() ), {} )
+		srid = dictOpts.get( 'srid', '' )
+		extent = self.layerExtent( l ).toString()
+		if metadata.get( 'extentEstimated' ):
+			extent += " (estimated)"
+
+		if l.type() == 0: # Vector
+			if 'featureCount' in metadata:
+				count = metadata['featureCount']
+			elif metadata.get( 'estimatedRows', -1 ) >= 0 and layerFilter( dictOpts ):
+				count = "~%s in the whole table (estimated)" % metadata['estimatedRows']
+			elif metadata.get( 'estimatedRows', -1 ) >= 0:
+				count = "~%s (estimated)" % metadata['estimatedRows']
+			else:
+				count = "unknown"
+
+			wkbType = ["WKBUnknown","WKBPoint","WKBLineString","WKBPolygon",
+					   "WKBMultiPoint","WKBMultiLineString","WKBMultiPolygon",
+					   "WKBNoGeometry","WKBPoint25D","WKBLineString25D","WKBPolygon25D",
+					   "WKBMultiPoint25D","WKBMultiLineString25D","WKBMultiPolygon25D"]
+			properties = "Source: %s\n" \
+						 "Geometry type: %s\n" \
+						 "Number of features: %s\n" \
+						 "Number of fields: %s\n" \
+						 "SRS (EPSG): %s\n" \
+						 "Extent: %s " \
+						  % ( l.source(), wkbType[l.wkbType()], count, 
+							  metadata.get( 'fieldCount' ) or l.dataProvider().fieldCount(), srid, extent )
+		elif l.type() == 1: # Raster
+			rType = [ "GrayOrUndefined (single band)", "Palette (single band)", "Multiband" ]
+			properties = "Source: %s\n" \
+						 "Raster type: %s\n" \
+						 "Width-Height (pixels): %sx%s\n" \
+						 "Bands: %s\n" \
+						 "SRS (EPSG): %s\n" \
+						 "Extent: %s" \
+						 % ( l.source(), rType[l.rasterType()], l.width(), l.height(),
+							 l.bandCount(), srid, extent )
+		return properties
+
+	def changeScale( self, scale ):
+		self.lblScale.setText( "Scale 1:" + formatNumber( scale ) )
+
+	def updateXY( self, p ):
+		if self.canvas.mapUnits() == 2: # Degrees
+			self.lblXY.setText( formatToDegrees( p.x() ) + " | " \
+				+ formatToDegrees( p.y() ) )
+		else: # Unidad lineal
+			self.lblXY.setText( formatNumber( p.x() ) + " | " \
+				+ formatNumber( p.y() ) + "" )
+
+
+# A couple of classes for the layer list widget and the layer properties
+class RefreshScheduler( QObject ):
+	"""
+	  Merge the redraw requests of a canvas arriving within delay milliseconds
+	  into a single render. The canvas is frozen until then, so setting its
+	  layers or extent meanwhile does not render either, and a render in
+	  progress is stopped because a newer one will replace it. Every render
+	  ends with SIGNAL( "rendered" )
+	"""
+	def __init__( self, canvas, delay ):
+		QObject.__init__( self, canvas )
+		self.canvas = canvas
+		self.timer = QTimer( self )
+		self.timer.setSingleShot( True )
+		self.timer.setInterval( delay )
+		self.connect( self.timer, SIGNAL( "timeout()" ), self.render )
+
+	def schedule( self ):
+		""" Request a redraw of the canvas """
+		if self.canvas.isDrawing():
+			self.canvas.stopRendering()
+		if not self.timer.isActive():
+			self.canvas.freeze( True )
+			self.timer.start()
+
+	def isPending( self ):
+		""" Return True if a render is scheduled """
+		return self.timer.isActive()
+
+	def render( self ):
+		if self.canvas.isDrawing(): # The stopped render has not returned yet
+			self.timer.start()
+			return
+		self.canvas.freeze( False )
+		with timed( 'render', layers=self.canvas.layerCount() ):
+			self.canvas.refresh()
+		self.emit( SIGNAL( "rendered" ) )
+
+
+class LegendItem( QTreeWidgetItem ):
+	""" Provide a widget to show and manage the properties of one single layer """
+	def __init__( self, parent, canvasLayer ):
+		QTreeWidgetItem.__init__( self )
+		self.legend = parent
+		self.canvasLayer = canvasLayer
+		self.variantLayer = None # Drawn instead of the layer, e.g. a generalized version
+		self.canvasLayer.layer().setLayerName( self.legend.normalizeLayerName( unicode( self.canvasLayer.layer().name() ) ) )
+		self.setText( 0, self.canvasLayer.layer().name() )
+		self.isVect = ( self.canvasLayer.layer().type() == 0 ) # 0: Vector, 1: Raster
+		self.layerId = self.canvasLayer.layer().getLayerID()
+
+		if self.isVect:
+			geom = self.canvasLayer.layer().dataProvider().geometryType()
+
+		self.setCheckState( 0, Qt.Checked )
+
+		pm = QPixmap( 20, 20 )
+		icon = QIcon()
+
+		if self.isVect:
+			if geom == 1 or geom == 4 or geom == 8 or geom == 11: # Point
+				icon.addPixmap( QPixmap( imgs_dir + "mIconPointLayer.png" ), QIcon.Normal, QIcon.On)
+			elif geom == 2 or geom == 5 or geom == 9 or geom == 12: # Polyline
+				icon.addPixmap( QPixmap( imgs_dir + "mIconLineLayer.png"), QIcon.Normal, QIcon.On)
+			elif geom == 3 or geom == 6 or geom == 10 or geom == 13: # Polygon
+				icon.addPixmap( QPixmap( imgs_dir + "mIconPolygonLayer.png"), QIcon.Normal, QIcon.On)
+			else: # Not a valid WKT Geometry
+				geom = self.canvasLayer.layer().geometryType() # QGis Geometry
+				if geom == 0: # Point
+					icon.addPixmap( QPixmap( imgs_dir + "mIconPointLayer.png" ), QIcon.Normal, QIcon.On)
+				elif geom == 1: # Line
+					icon.addPixmap( QPixmap( imgs_dir + "mIconLineLayer.png"), QIcon.Normal, QIcon.On)
+				elif geom == 2: # Polygon
+					icon.addPixmap( QPixmap( imgs_dir + "mIconPolygonLayer.png"), QIcon.Normal, QIcon.On)
+				else:
+					raise RuntimeError, 'Unknown geometry: ' + str( geom )
+
+		else: # Placeholder until the thumbnail is rendered in the background
+			pm.fill( Qt.lightGray )
+			icon.addPixmap( pm )
+
+		self.setIcon( 0, icon )
+
+		#self.setToolTip( 0, self.canvasLayer.layer().publicSource() )
+		layerFont = QFont()
+		layerFont.setBold( True )
+		self.setFont( 0, layerFont )
+
+		# Display layer properties, generated once (the item is shown expanded) and
+		# again only when they change, see updateLayerProperties
+		self.properties = None
+		self.child = QTreeWidgetItem( self )
+		self.child.setFlags( Qt.NoItemFlags ) # Avoid the item to be selected
+		self.displayLayerProperties()
+		
+	def updateLayerProperties( self ):
+		""" Generate the properties again (e.g. an exact count replaced an estimate) """
+		self.properties = None
+		self.displayLayerProperties()
+
+	def displayLayerProperties( self ):
+		""" It is required to build the QLabel widget every time it is set """		  
+		if self.properties is None:
+			self.properties = self.legend.pyQGisApp.getLayerProperties( self.canvasLayer.layer() )
+		propertiesFont = QFont()
+		propertiesFont.setItalic( True )
+		propertiesFont.setPointSize( 8 )
+		propertiesFont.setStyleStrategy( QFont.PreferAntialias )
+
+		label = QLabel( self.properties )
+		label.setTextInteractionFlags( Qt.TextSelectableByMouse | Qt.TextSelectableByKeyboard )
+		label.setFont( propertiesFont )
+		self.legend.setItemWidget( self.child, 0, label )
+		
+	def setThumbnail( self, pixmap ):
+		""" Replace the placeholder icon of a raster """
+		icon = QIcon()
+		icon.addPixmap( pixmap )
+		self.setIcon( 0, icon )
+
+	def setPartial( self, partial ):
+		""" Mark the item while only a sample of its layer is drawn """
+		if partial:
+			self.setText( 0, self.canvasLayer.layer().name() + " (preview)" )
+		else:
+			self.setText( 0, self.canvasLayer.layer().name() )
+
+	def mapCanvasLayer( self ):
+		""" Return the canvas layer to draw for this item """
+		if self.variantLayer is not None:
+			return self.variantLayer
+		return self.canvasLayer
+
+	def setRenderLayer( self, layer ):
+		""" Draw layer instead of the item layer, the item layer again if None.
+			Return False if it is already drawn """
+		current = self.variantLayer and self.variantLayer.layer()
+		if current is layer or ( current and layer and current.getLayerID() == layer.getLayerID() ):
+			return False
+		if layer is None:
+			self.variantLayer = None
+		else:
+			self.variantLayer = QgsMapCanvasLayer( layer )
+			self.variantLayer.setVisible( self.canvasLayer.isVisible() )
+		return True
+
+	def storeAppearanceSettings( self ):
+		""" Store the appearance of the layer item """
+		self.__itemIsExpanded = self.isExpanded()
+
+	def restoreAppearanceSettings( self ):
+		""" Restore the appearance of the layer item """
+		self.setExpanded( self.__itemIsExpanded )
+		self.displayLayerProperties() # Generate the QLabel widget again
+		
+
+class PendingLegendItem( QTreeWidgetItem ):
+	""" Placeholder shown in the legend while a layer is being loaded """
+	def __init__( self, taskId, label ):
+		QTreeWidgetItem.__init__( self )
+		self.taskId = taskId
+		self.layerId = None
+		self.setText( 0, label + " (loading...)" )
+		self.setFlags( Qt.ItemIsEnabled ) # Neither checkable nor draggable
+		pendingFont = QFont()
+		pendingFont.setItalic( True )
+		self.setFont( 0, pendingFont )
+
+
+class Legend( QTreeWidget ):
+	"""
+	  Provide a widget that manages map layers and their properties as tree items
+	"""
+	def __init__( self, parent ):
+		QTreeWidget.__init__( self, parent )
+
+		self.pyQGisApp = parent
+		self.canvas = None
+		self.layers = self.getLayerSet()
+
+		self.bMousePressedFlag = False
+		self.itemBeingMoved = None
+		self.dragRow = None # Row of the item being moved, looked up once at drag start
+		self.dropRow = None # Row the item being moved will be inserted before
+		self.pendingItems = {} # Layers being loaded by task id
+		self.layerItems = {} # Layer items by layer id
+		self.layerNames = set() # Names shown for the layer items
+		self.nameSuffixes = {} # Next suffix to try for a repeated name
+
+		# QTreeWidget properties
+		self.setSortingEnabled( False )
+		self.setDragEnabled( False )
+		self.setAutoScroll( False )
+		self.setHeaderHidden( True )
+		self.setRootIsDecorated( True )
+		self.setContextMenuPolicy( Qt.CustomContextMenu )
+
+		self.connect( self, SIGNAL( "customContextMenuRequested(QPoint)" ),
+			self.showMenu )
+		self.connect( QgsMapLayerRegistry.instance(), SIGNAL("layerWasAdded(QgsMapLayer *)"),
+			self.addLayerToLegend )
+		self.connect( QgsMapLayerRegistry.instance(), SIGNAL( "removedAll()" ),
+			self.removeAll )
+		self.connect( self, SIGNAL( "itemChanged(QTreeWidgetItem *,int)" ),
+			self.updateLayerStatus )
+		self.connect( self, SIGNAL( "currentItemChanged(QTreeWidgetItem *, QTreeWidgetItem *)" ),
+			self.currentItemChanged )
+			
+	def setCanvas( self, canvas ):
+		""" Set the base canvas """
+		self.canvas = canvas
+
+	def showMenu( self, pos ):
+		""" Show a context menu for the active layer in the legend """
+		item = self.itemAt( pos )
+		if item:
+			if self.isPendingItem( item ):
+				self.menu = QMenu()
+				self.menu.addAction( "&Cancel loading", lambda: self.pyQGisApp.loader.cancel( item.taskId ) )
+				self.menu.popup( QPoint( self.mapToGlobal( pos ).x() + 5, self.mapToGlobal( pos ).y() ) )
+			elif self.isLegendLayer( item ):
+				self.setCurrentItem( item )
+				self.menu = self.getMenu( item.isVect, item.canvasLayer )
+				self.menu.popup( QPoint( self.mapToGlobal( pos ).x() + 5, self.mapToGlobal( pos ).y() ) )
+
+	def getMenu( self, isVect, canvasLayer ):
+		""" Create a context menu for a layer """
+		menu = QMenu()
+		menu.addAction( QIcon( imgs_dir + "mActionZoomToLayer.png" ), "&Zoom to layer extent", self.zoomToLayer )
+		menu.addSeparator()
+		if isVect :
+			menu.addAction( "Zoom to e&xact extent", self.zoomToExactExtent )
+			menu.addAction( "C&ount features", self.countFeatures )
+			menu.addSeparator()
+			menu.addAction( QIcon( imgs_dir + "symbology.png" ), "&Symbology...", self.layerSymbology )
+		menu.addSeparator()
+		menu.addAction( QIcon( imgs_dir + "collapse.png" ), "&Collapse all", self.collapseAll )
+		menu.addAction( QIcon( imgs_dir + "expand.png" ), "&Expand all", self.expandAll )
+		menu.addSeparator()
+		menu.addAction( QIcon( imgs_dir + "removeLayer.png" ), "&Remove layer", self.removeCurrentLayer )
+		return menu
+
+	def mousePressEvent(self, event):
+		""" Mouse press event to manage the layers drag """
+		if ( event.button() == Qt.LeftButton ):
+			self.lastPressPos = event.pos()
+			self.bMousePressedFlag = True
+		QTreeWidget.mousePressEvent( self, event )
+
+	def mouseMoveEvent(self, event):
+		""" Mouse move event to manage the layers drag """
+		if ( self.bMousePressedFlag ):
+			# Set the flag back such that the else if(itemBeingMoved)
+			# code part is passed during the next mouse moves
+			self.bMousePressedFlag = False
+
+			# Remember the item that has been pressed
+			item = self.itemAt( self.lastPressPos )
+			if ( item ):
+				if ( self.isLegendLayer( item ) ):
+					self.itemBeingMoved = item
+					self.dragRow = self.indexOfTopLevelItem( item ) # Only scan once per drag
+					self.dropRow = None
+					self.storeInitialPosition() # Store the initial layers order
+					self.setCursor( Qt.SizeVerCursor )
+				else:
+					self.setCursor( Qt.ForbiddenCursor )
+		elif ( self.itemBeingMoved ):
+			p = QPoint( event.pos() )
+			self.lastPressPos = p
+
+			# Only track the target row while dragging, the item is moved on release
+			dropRow = self.rowAt( p )
+			if dropRow is None:
+				self.setCursor( Qt.ForbiddenCursor )
+			else:
+				self.setCursor( Qt.SizeVerCursor )
+			if dropRow != self.dropRow:
+				self.dropRow = dropRow
+				self.viewport().update() # Redraw the drop indicator
+
+	def mouseReleaseEvent( self, event ):
+		""" Mouse release event to manage the layers drag """
+		QTreeWidget.mouseReleaseEvent( self, event )
+		self.setCursor( Qt.ArrowCursor )
+		self.bMousePressedFlag = False
+
+		if ( not self.itemBeingMoved ):
+			#print "*** Legend drag: No itemBeingMoved ***"
+			return
+
+		origin = self.itemBeingMoved
+		dropRow = self.rowAt( event.pos() ) # None if released out of the legend
+		if dropRow is not None and dropRow not in ( self.dragRow, self.dragRow + 1 ):
+			if dropRow > self.dragRow:
+				dropRow -= 1 # The row below shifts up once the item is taken
+			self.moveItem( origin, self.dragRow, dropRow )
+			self.setCurrentItem( origin )
+
+		self.itemBeingMoved = None
+		self.dragRow = None
+		self.dropRow = None
+		self.viewport().update() # Remove the drop indicator
+		self.checkLayerOrderUpdate()
+
+	def rowAt( self, pos ):
+		"""
+			Return the row the item being moved would be inserted before if dropped
+			at pos, or None if pos is not over a layer item
+		"""
+		index = self.indexAt( pos )
+		if not index.isValid() or index.parent().isValid(): # Out of the legend or a property
+			return None
+		row = index.row()
+		item = self.topLevelItem( row )
+		if not self.isLegendLayer( item ):
+			return None
+		if not self.yCoordAboveCenter( item, pos.y() ): # Below center of the item
+			row += 1
+		return row
+
+	def paintEvent( self, event ):
+		""" Draw the legend and, while dragging a layer, a line where it will be dropped """
+		QTreeWidget.paintEvent( self, event )
+		if self.itemBeingMoved is None or self.dropRow is None:
+			return
+		if self.dropRow < self.topLevelItemCount():
+			y = self.visualItemRect( self.topLevelItem( self.dropRow ) ).top()
+		else:
+			y = self.visualItemRect( self.topLevelItem( self.dropRow - 1 ) ).bottom()
+		painter = QPainter( self.viewport() )
+		painter.setPen( self.palette().highlight().color() )
+		painter.drawLine( 0, y, self.viewport().width(), y )
+		painter.end()
+
+	def addLayerToLegend( self, canvasLayer ):
+		""" Slot. Create and add a legend item based on a layer """
+		legendLayer = LegendItem( self, QgsMapCanvasLayer( canvasLayer ) )
+		self.addLayer( legendLayer )
+
+	def addPendingItem( self, taskId, label ):
+		""" Slot. Show a layer being loaded at the bottom of the legend """
+		item = PendingLegendItem( taskId, label )
+		self.pendingItems[ taskId ] = item
+		self.addTopLevelItem( item )
+
+	def removePendingItem( self, taskId ):
+		""" Slot. Remove the placeholder of a loaded, failed or cancelled layer """
+		item = self.pendingItems.pop( taskId, None )
+		if item is not None:
+			self.takeTopLevelItem( self.indexOfTopLevelItem( item ) )
+
+	def addLayer( self, legendLayer ):
+		""" Add a legend item to the legend widget """
+		self.layerItems[ unicode( legendLayer.layerId ) ] = legendLayer
+		self.insertTopLevelItem ( 0, legendLayer )
+		self.expandItem( legendLayer )
+		self.setCurrentItem( legendLayer )
+		self.updateLayerSet()
+
+	def updateLayerStatus( self, item ):
+		""" Update the layer status """
+		if ( item ):
+			if self.isLegendLayer( item ): # Is the item a layer item?
+				visible = item.checkState( 0 ) != Qt.Unchecked
+				item.canvasLayer.setVisible( visible )
+				if item.variantLayer is not None:
+					item.variantLayer.setVisible( visible )
+				self.pyQGisApp.refresher.schedule()
+				self.canvas.setLayerSet( self.layers )
+
+	def currentItemChanged( self, newItem, oldItem ):
+		""" Slot. Capture a new currentItem and emit a SIGNAL to inform the new type 
+			It could be used to activate/deactivate GUI buttons according the layer type
+		"""
+		layerType = None
+
+		if self.currentItem() and not self.isPendingItem( newItem ):
+			if self.isLegendLayer( newItem ):
+				layerType = newItem.canvasLayer.layer().type()
+				self.canvas.setCurrentLayer( newItem.canvasLayer.layer() )
+			else:
+				layerType = newItem.parent().canvasLayer.layer().type()
+				self.canvas.setCurrentLayer( newItem.parent().canvasLayer.layer() )
+
+		self.emit( SIGNAL( "activeLayerChanged" ), layerType )
+
+	def zoomToLayer( self ):
+		""" Slot. Manage the zoomToLayer action in the context Menu """
+		self.zoomToLegendLayer( self.currentItem() )
+
+	def zoomToExactExtent( self ):
+		""" Slot. Manage the zoomToExactExtent action in the context Menu """
+		self.pyQGisApp.zoomToExactExtent( self.currentItem().canvasLayer.layer() )
+
+	def countFeatures( self ):
+		""" Slot. Manage the countFeatures action in the context Menu """
+		self.pyQGisApp.countFeatures( self.currentItem().canvasLayer.layer() )
+
+	def layerItem( self, layerId ):
+		""" Return the item of a layer, None if it is not in the legend """
+		return self.layerItems.get( unicode( layerId ) )
+
+	def updateLayerProperties( self, layerId ):
+		""" Regenerate the properties shown for a layer """
+		item = self.layerItem( layerId )
+		if item is not None:
+			item.updateLayerProperties()
+
+	def removeCurrentLayer( self ):
+		""" Slot. Manage the removeCurrentLayer action in the context Menu """
+		QgsMapLayerRegistry.instance().removeMapLayer( self.currentItem().canvasLayer.layer().getLayerID() )
+		self.removeLegendLayer( self.currentItem() )
+		self.updateLayerSet()
+
+	def layerSymbology( self ):
+		""" Change the features color of a vector layer """
+		legendLayer = self.currentItem()
+		
+		if legendLayer.isVect == True:
+			layer = legendLayer.canvasLayer.layer()
+			geom = layer.geometryType() # QGis Geometry
+			if geom == 1: # Line
+				color = QColorDialog.getColor( layer.renderer().symbols()[ 0 ].color(), self.pyQGisApp )
+			else:
+				color = QColorDialog.getColor( layer.renderer().symbols()[ 0 ].fillColor(), self.pyQGisApp )
+
+			if color.isValid():
+				pm = QPixmap()
+				iconChild = QIcon()
+				if geom == 1: # Line
+					legendLayer.canvasLayer.layer().renderer().symbols()[ 0 ].setColor( color )										  
+				else:  
+					legendLayer.canvasLayer.layer().renderer().symbols()[ 0 ].setFillColor( color )
+				layer.setCacheImage( None ) # Render it again, with the new color
+				for variant in self.pyQGisApp.variantLayers( legendLayer.layerId ):
+					copySymbology( layer, variant )
+
+				self.pyQGisApp.refresher.schedule()
+
+	def zoomToLegendLayer( self, legendLayer ):
+		""" Zoom the map to a layer extent """
+		extent = self.pyQGisApp.layerExtent( legendLayer.canvasLayer.layer() )
+		extent.scale( 1.05 )
+		self.pyQGisApp.refresher.schedule()
+		self.canvas.setExtent( extent )
+
+	def setRenderLayer( self, layerId, layer ):
+		""" Draw layer instead of the layer with layerId (or that one if None).
+			Return True if the layer set has to be updated """
+		item = self.layerItem( layerId )
+		if item is None:
+			return False
+		return item.setRenderLayer( layer )
+
+	def removeLegendLayer( self, legendLayer ):
+		""" Remove a layer item in the legend """
+		self.layerItems.pop( unicode( legendLayer.layerId ), None )
+		self.layerNames.discard( unicode( legendLayer.canvasLayer.layer().name() ) )
+		if self.topLevelItemCount() == 1:
+			self.clear()
+		else: # Manage the currentLayer before the remove
+			indice = self.indexOfTopLevelItem( legendLayer )
+			if indice == 0:
+				newCurrentItem = self.topLevelItem( indice + 1 )
+			else:
+				newCurrentItem = self.topLevelItem( indice - 1 )
+
+			self.setCurrentItem( newCurrentItem )
+			self.takeTopLevelItem( self.indexOfTopLevelItem( legendLayer ) )
+
+	def removeAll( self ):
+		""" Remove all legend items """
+		self.clear()
+		self.pendingItems.clear()
+		self.layerItems.clear()
+		self.layerNames.clear()
+		self.nameSuffixes.clear()
+		self.updateLayerSet()
+
+	def updateLayerSet( self ):
+		""" Update the LayerSet and set it to canvas """
+		self.layers = self.getLayerSet()
+		self.pyQGisApp.refresher.schedule()
+		self.canvas.setLayerSet( self.layers )
+
+	def getLayerSet( self ):
+		""" Get the LayerSet by reading the layer items in the legend """
+		layers = []
+		for i in range( self.topLevelItemCount() ):
+			if self.isLegendLayer( self.topLevelItem( i ) ):
+				layers.append( self.topLevelItem( i ).mapCanvasLayer() )
+		return layers
+
+	def activeLayer( self ):
+		""" Return the selected layer """
+		if self.currentItem() and not self.isPendingItem( self.currentItem() ):
+			if self.isLegendLayer( self.currentItem() ):
+				return self.currentItem().canvasLayer
+			else:
+				return self.currentItem().parent().canvasLayer
+		else:
+			return None
+
+	def collapseAll( self ):
+		""" Collapse all layer items in the legend """
+		for i in range( self.topLevelItemCount() ):
+			item = self.topLevelItem( i )
+			self.collapseItem( item )
+
+	def expandAll( self ):
+		""" Expand all layer items in the legend """
+		for i in range( self.topLevelItemCount() ):
+			item = self.topLevelItem( i )
+			self.expandItem( item )
+
+	def isLegendLayer( self, item ):
+		""" Check if a given item is a layer item """
+		return not item.parent() and not self.isPendingItem( item )
+
+	def isPendingItem( self, item ):
+		""" Check if a given item is a layer being loaded """
+		return isinstance( item, PendingLegendItem )
+
+	def storeInitialPosition( self ):
+		""" Store the layers order """
+		self.__beforeDragStateLayers = self.getLayerIDs()
+
+	def getLayerIDs( self ):
+		""" Return a list with the layers ids """
+		layers = []
+		for i in range( self.topLevelItemCount() ):
+			item = self.topLevelItem( i )
+			if self.isLegendLayer( item ):
+				layers.append( item.layerId )
+		return layers
+
+	def moveItem( self, itemToMove, fromRow, toRow ):
+		""" Move the itemToMove from the row fromRow to the row toRow in the legend """
+		itemToMove.storeAppearanceSettings() # Store settings in the moved item
+		self.takeTopLevelItem( fromRow )
+		self.insertTopLevelItem( toRow, itemToMove )
+		itemToMove.restoreAppearanceSettings() # Apply the settings again
+		# Place the QLabel widgets of the other items again, at most once per event
+		# loop pass, so that they do not overlap
+		self.scheduleDelayedItemsLayout()
+			
+	def checkLayerOrderUpdate( self ):
+		"""
+			Check if the initial layers order is equal to the final one.
+			This is used to refresh the legend in the release event.
+		"""
+		self.__afterDragStateLayers = self.getLayerIDs()
+		if self.__afterDragStateLayers != self.__beforeDragStateLayers:
+			self.updateLayerSet()
+			
+	def yCoordAboveCenter( self, legendItem, ycoord ):
+		"""
+			Return a bool to know if the ycoord is in the above center of the legendItem
+
+			legendItem: The base item to get the above center and the below center
+			ycoord: The coordinate of the comparison
+		"""
+		rect = self.visualItemRect( legendItem )
+		height = rect.height()
+		top = rect.top()
+		mid = top + ( height / 2 )
+		if ( ycoord > mid ): # Bottom, remember the y-coordinate increases downwards
+			return False
+		else: # Top
+			return True
+
+	def normalizeLayerName( self, name ):
+		""" Create an alias to put in the legend and avoid to repeat names """
+		# Remove the extension
+		if len( name ) > 4:
+			if name[ -4 ] == '.':
+				name = name[ :-4 ]
+		return self.createUniqueName( name )
+
+	def createUniqueName( self, name ):
+		""" Avoid to repeat layers names, adding a sufix like " (1)" if necessary """
+		uniqueName = name
+		if uniqueName in self.layerNames:
+			i = self.nameSuffixes.get( name, 1 )
+			while uniqueName in self.layerNames:
+				uniqueName = name + ' (' + str( i ) + ')'
+				i += 1
+			self.nameSuffixes[ name ] = i
+		self.layerNames.add( uniqueName )
+		return uniqueName
+
+
+# Some helpful functions
+def formatNumber( number, precision=0, group_sep='.', decimal_sep=',' ):
+	"""
+		number: Number to be formatted 
+		precision: Number of decimals
+		group_sep: Miles separator
+		decimal_sep: Decimal separator
+	"""
+	number = ( '%.*f' % ( max( 0, precision ), number ) ).split( '.' )
+	integer_part = number[ 0 ]
+
+	if integer_part[ 0 ] == '-':
+		sign = integer_part[ 0 ]
+		integer_part = integer_part[ 1: ]
+	else:
+		sign = ''
+
+	if len( number ) == 2:
+		decimal_part = decimal_sep + number[ 1 ]
+	else:
+		decimal_part = ''
+
+	integer_part = list( integer_part )
+	c = len( integer_part )
+
+	while c > 3:
+		c -= 3
+		integer_part.insert( c, group_sep )
+
+	return sign + ''.join( integer_part ) + decimal_part
+
+def formatToDegrees( number ):
+	""" Returns the degrees-minutes-seconds form of number """
+	sign = ''
+	if number < 0:
+		number = math.fabs( number )
+		sign = '-'
+
+	deg = math.floor( number )
+	minu = math.floor( ( number - deg ) * 60 )
+	sec = ( ( ( number - deg ) * 60 ) - minu ) * 60 
+
+	return sign + "%.0f"%deg + '\xba ' + "%.0f"%minu + "' " \
+		+ "%.2f"%sec + "\""
+
+def connectionName( dictOpts ):
+	""" Return the name of the QSqlDatabase connection used for a server/database/user
+		in the current thread (connections can not be shared between threads) """
+	return "PgSQLDb_%s_%s_%s_%s_%s" % ( dictOpts['-h'], dictOpts['-p'], dictOpts['-d'], dictOpts['-U'], thread.get_ident() )
+
+def openConnection( dictOpts ):
+	""" Return an open database connection, reusing the one already held for the same database """
+	name = connectionName( dictOpts )
+	if QSqlDatabase.contains( name ):
+		d = QSqlDatabase.database( name, False )
+		if not d.isOpen():
+			d.open()
+		return d
+
+	d = QSqlDatabase.addDatabase( "QPSQL", name )
+	d.setHostName( dictOpts['-h'] )
+	d.setPort( int( dictOpts['-p'] ) )
+	d.setDatabaseName( dictOpts['-d'] )
+	d.setUserName( dictOpts['-U'] )
+	d.setPassword( dictOpts['-W'] )
+	with timed( 'connect', host=dictOpts['-h'], database=dictOpts['-d'] ):
+		opened = d.open()
+	if opened:
+		print 'I: Database connection was succesfull'
+	return d
+
+def quoteLiteral( value ):
+	""" Quote a string to be used as a SQL literal """
+	return "'" + value.replace( "'", "''" ) + "'"
+
+def tableNames( dictOpts ):
+	""" Return the table names or patterns of a request (-t a,b,c), none for a whole schema """
+	return [ name.strip() for name in dictOpts['-t'].split( ',' ) if name.strip() ]
+
+def isPattern( name ):
+	return '*' in name or '?' in name
+
+def tableCondition( column, names ):
+	""" SQL condition matching column against table names and * ? patterns """
+	if not names:
+		return "TRUE"
+	conditions = []
+	for name in names:
+		if isPattern( name ):
+			like = name.replace( '!', '!!' ).replace( '%', '!%' ).replace( '_', '!_' )
+			like = like.replace( '*', '%' ).replace( '?', '_' )
+			conditions.append( "%s LIKE %s ESCAPE '!'" % ( column, quoteLiteral( like ) ) )
+		else:
+			conditions.append( "%s = %s" % ( column, quoteLiteral( name ) ) )
+	return "( " + " OR ".join( conditions ) + " )"
+
+# Catalog query returning the table, layer type, column, SRID, geometry type,
+# estimated number of rows (-1 if unknown: never analyzed, empty or a view), the band nodata values of
+# rasters (comma separated, empty for a band without one) and the priority of
+# the row in one round trip. Rasters take precedence, then registered geometry
+# columns, then any other geometry column (unregistered tables have unknown
+# SRID and type, composite types and the PostGIS catalog views are skipped).
+# Overview tables are drawn with their raster, they are listed only if named.
+# The raster part depends on the raster catalog of the database
+# Estimated rows of a pg_class row c, NULL if unknown (reltuples is 0 before
+# the first ANALYZE until PostgreSQL 14, and for views)
+estimatedRowsSql = "CASE WHEN c.relkind IN ( 'r', 'm' ) AND c.reltuples > 0 THEN c.reltuples END"
+rasterCatalogSql = "SELECT r_table_name, 'raster', r_raster_column, srid, '', \
+		( SELECT " + estimatedRowsSql + " FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace \
+			WHERE n.nspname = r_table_schema AND c.relname = r_table_name ), \
+		%(nodata)s, 0 \
+		FROM raster_columns \
+		WHERE r_table_schema = %(schema)s AND %(rasterTables)s \
+		AND ( %(namedRasterTables)s OR %(notOverview)s ) \
+	UNION ALL "
+rasterOverviewCondition = "NOT EXISTS ( SELECT 1 FROM raster_overviews o \
+			WHERE o.o_table_schema = r_table_schema AND o.o_table_name = r_table_name )"
+layerCatalogSql = "SELECT f_table_name, 'vector', f_geometry_column, srid, type, \
+		( SELECT " + estimatedRowsSql + " FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace \
+			WHERE n.nspname = f_table_schema AND c.relname = f_table_name ), NULL, 1 \
+		FROM geometry_columns \
+		WHERE f_table_schema = %(schema)s AND %(vectorTables)s \
+	UNION ALL \
+	SELECT c.relname, 'vector', a.attname, -1, '', " + estimatedRowsSql + ", NULL, 2 FROM pg_attribute a \
+		JOIN pg_class c ON c.oid = a.attrelid \
+		JOIN pg_namespace n ON n.oid = c.relnamespace \
+		WHERE n.nspname = %(schema)s AND %(classTables)s AND a.attnum > 0 \
+		AND c.relkind IN ( 'r', 'v', 'm', 'f', 'p' ) AND NOT c.relname IN ( 'geometry_columns', \
+			'geography_columns', 'raster_columns', 'raster_overviews' ) \
+		AND NOT a.attisdropped AND a.atttypid = ( SELECT oid FROM pg_type WHERE typname = 'geometry' LIMIT 1 ) \
+	ORDER BY 1, 8"
+
+# Columns of the raster catalog views ( 'raster_columns.nodata_values', ... ) by connection
+rasterCatalogColumns = {}
+
+def rasterCatalog( d ):
+	""" Return the columns of the raster catalog views visible on a connection,
+		an empty set without raster support, None if it could not be read """
+	name = d.connectionName()
+	if name in rasterCatalogColumns:
+		return rasterCatalogColumns[ name ]
+	query = QSqlQuery( d )
+	if not query.exec_( "SELECT c.relname, a.attname FROM pg_class c \
+			JOIN pg_attribute a ON a.attrelid = c.oid \
+		WHERE c.relname IN ( 'raster_columns', 'raster_overviews' ) AND pg_table_is_visible( c.oid ) \
+		AND a.attnum > 0 AND NOT a.attisdropped" ):
+		print >> sys.stderr, 'E: Raster catalog not read: %s' % query.lastError().text()
+		return None # Asked again with the next request
+	columns = set()
+	while query.next():
+		columns.add( '%s.%s' % ( unicode( query.value( 0 ).toString() ), unicode( query.value( 1 ).toString() ) ) )
+	if not 'raster_columns.r_raster_column' in columns:
+		print 'I: No raster catalog found'
+	rasterCatalogColumns[ name ] = columns
+	return columns
+
+class LayerMetadataCache:
+	""" Keep the detected layer metadata keyed by (host, port, db, schema, table, filters) """
+	def __init__( self, ttl ):
+		self.ttl = ttl # Seconds an entry is considered valid
+		self.entries = {}
+		self.lock = threading.Lock() # Used by the loader threads
+
+	def key( self, dictOpts ):
+		# The extent and the count depend on the filters
+		return ( dictOpts['-h'], dictOpts['-p'], dictOpts['-d'], dictOpts['-s'], dictOpts['-t'],
+			dictOpts.get( '-w', '' ), dictOpts.get( '-b', '' ) )
+
+	def get( self, dictOpts ):
+		""" Return the cached metadata of a table or None if it is unknown or expired """
+		key = self.key( dictOpts )
+		self.lock.acquire()
+		try:
+			if not key in self.entries:
+				return None
+			timestamp, metadata = self.entries[ key ]
+			if time.time() - timestamp > self.ttl:
+				del self.entries[ key ]
+				return None
+			return metadata
+		finally:
+			self.lock.release()
+
+	def put( self, dictOpts, metadata ):
+		self.lock.acquire()
+		self.entries[ self.key( dictOpts ) ] = ( time.time(), metadata )
+		self.lock.release()
+
+	def update( self, dictOpts, **values ):
+		""" Add values (e.g. a computed extent) to the cached metadata of a table """
+		self.lock.acquire()
+		key = self.key( dictOpts )
+		if key in self.entries:
+			self.entries[ key ][ 1 ].update( values )
+		self.lock.release()
+
+	def invalidate( self, dictOpts=None ):
+		""" Forget the metadata of a table, or of all tables if no table is given """
+		self.lock.acquire()
+		if dictOpts is None:
+			self.entries.clear()
+		elif self.key( dictOpts ) in self.entries:
+			del self.entries[ self.key( dictOpts ) ]
+		self.lock.release()
+
+layerMetadataCache = LayerMetadataCache( 300 )
+
+def queryLayers( d, schema, names ):
+	""" Run the catalog query for the tables matching names in schema.
+		Return a list of ( table, metadata ) sorted by table name """
+	namedTables = [ name for name in names if not isPattern( name ) ]
+	params = { 'schema': quoteLiteral( schema ),
+		'rasterTables': tableCondition( 'r_table_name', names ),
+		'namedRasterTables': namedTables and tableCondition( 'r_table_name', namedTables ) or "FALSE",
+		'vectorTables': tableCondition( 'f_table_name', names ),
+		'classTables': tableCondition( 'c.relname', names ) }
+	sql = layerCatalogSql
+	columns = rasterCatalog( d ) or set()
+	if 'raster_columns.r_raster_column' in columns:
+		sql = rasterCatalogSql + layerCatalogSql
+		params['nodata'] = "NULL"
+		if 'raster_columns.nodata_values' in columns:
+			params['nodata'] = "array_to_string( nodata_values, ',', '' )"
+		params['notOverview'] = "TRUE"
+		if 'raster_overviews.o_table_name' in columns:
+			params['notOverview'] = rasterOverviewCondition
+	query = QSqlQuery( d )
+	if not query.exec_( sql % params ):
+		print >> sys.stderr, 'E: Catalog query failed: %s' % query.lastError().text()
+		return []
+
+	layers = {}
+	while query.next():
+		table = unicode( query.value( 0 ).toString() )
+		if table in layers: # Ordered by priority: raster, registered geometry, any geometry
+			continue
+		layers[ table ] = { 'type': str( query.value( 1 ).toString() ),
+			'column': str( query.value( 2 ).toString() ),
+			'srid': str( query.value( 3 ).toString() ),
+			'geometryType': str( query.value( 4 ).toString() ),
+			'estimatedRows': long( query.value( 5 ).toDouble()[ 0 ] ) if not query.isNull( 5 ) else -1 }
+		if layers[ table ]['type'] == 'raster':
+			layers[ table ]['nodata'] = parseNoDataValues( query.value( 6 ).toString() )
+
+	for table, metadata in layers.items():
+		if metadata['type'] == 'raster' and metadata['nodata'] is None: # No constraints, ask a tile
+			metadata['nodata'] = bandNoDataValues( d, schema, table, metadata['column'] )
+	return sorted( layers.items() )
+
+def parseNoDataValues( text ):
+	""" Return the nodata value (None if it has none) per band of a comma separated list,
+		None if there is no list """
+	text = str( text )
+	if not text:
+		return None
+	return [ float( value ) if value else None for value in text.split( ',' ) ]
+
+def bandNoDataValues( d, schema, table, column ):
+	""" Return the nodata values of the bands of the first tile of a raster """
+	query = QSqlQuery( d )
+	query.exec_( "SELECT array_to_string( ARRAY( SELECT coalesce( ST_BandNoDataValue( r, b )::text, '' ) \
+		FROM generate_series( 1, ST_NumBands( r ) ) b ), ',' ) \
+		FROM ( SELECT %s AS r FROM %s.%s LIMIT 1 ) t" % ( quoteIdent( column ), quoteIdent( schema ),
+		quoteIdent( table ) ) )
+	if query.next():
+		return parseNoDataValues( query.value( 0 ).toString() )
+	return None
+
+def expandRequest( d, dictOpts ):
+	""" Detect the layers of a request (one table, a list, a pattern or a whole schema).
+		Return a copy of dictOpts per layer with its type, geometry column and SRID """
+	names = tableNames( dictOpts )
+	found = []
+	missing = []
+	for name in names:
+		metadata = None
+		if not isPattern( name ):
+			metadata = layerMetadataCache.get( dict( dictOpts, **{ '-t': name } ) )
+		if metadata is None:
+			missing.append( name )
+		else:
+			found.append( ( name, metadata ) )
+
+	if missing or not names:
+		with timed( 'catalog', schema=dictOpts['-s'], tables=len( missing ) ):
+			detected = queryLayers( d, dictOpts['-s'], missing )
+		for table, metadata in detected:
+			layerMetadataCache.put( dict( dictOpts, **{ '-t': table } ), metadata )
+			found.append( ( table, metadata ) )
+
+	layers = []
+	for table, metadata in found:
+		layerOpts = dict( dictOpts, **{ '-t': table, 'type': metadata['type'], 'srid': metadata['srid'] } )
+		if metadata['type'] == 'vector':
+			layerOpts['-g'] = metadata['column']
+		print 'I: %s layer detected: %s.%s' % ( metadata['type'].capitalize(), dictOpts['-s'], table )
+		layers.append( layerOpts )
+	return layers
+
+def quoteIdent( name ):
+	""" Quote a SQL identifier """
+	return '"' + name.replace( '"', '""' ) + '"'
+
+def queryExtent( query, sql ):
+	""" Run a query whose only column is a box, return ( xmin, ymin, xmax, ymax ) or None """
+	if not query.exec_( "SELECT ST_XMin(e), ST_YMin(e), ST_XMax(e), ST_YMax(e) FROM ( %s ) s" % sql ):
+		return None
+	if not query.next() or query.isNull( 0 ):
+		return None
+	return tuple( [ query.value( i ).toDouble()[ 0 ] for i in range( 4 ) ] )
+
+# Function used to estimate extents on a connection, named ST_Estimated_Extent before PostGIS 2.1
+estimatedExtentFunctions = {}
+
+def layerFilter( dictOpts ):
+	""" Return the SQL condition selecting the rows of a vector layer (-w and -b), '' for all """
+	conditions = []
+	if dictOpts.get( '-w' ):
+		conditions.append( "( %s )" % dictOpts['-w'] )
+	if dictOpts.get( '-b' ):
+		xmin, ymin, xmax, ymax = [ float( value ) for value in dictOpts['-b'].split( ',' ) ]
+		conditions.append( "%s && ST_SetSRID( ST_MakeBox2D( ST_Point( %.17g, %.17g ), ST_Point( %.17g, %.17g ) ), %s )" % (
+			quoteIdent( dictOpts['-g'] ), xmin, ymin, xmax, ymax, dictOpts['srid'] ) )
+	return ' AND '.join( conditions )
+
+def whereClause( dictOpts ):
+	""" Return the WHERE clause of the layer filter, '' if there is none """
+	condition = layerFilter( dictOpts )
+	return condition and " WHERE " + condition
+
+def estimatedExtent( d, dictOpts ):
+	""" Return the extent of a vector layer from the planner statistics, None if there are none """
+	name = d.connectionName()
+	for function in ( 'ST_EstimatedExtent', 'ST_Estimated_Extent' ):
+		if estimatedExtentFunctions.get( name, function ) != function:
+			continue
+		query = QSqlQuery( d )
+		extent = queryExtent( query, "SELECT %s( %s, %s, %s ) AS e" % ( function,
+			quoteLiteral( dictOpts['-s'] ), quoteLiteral( dictOpts['-t'] ), quoteLiteral( dictOpts['-g'] ) ) )
+		error = unicode( query.lastError().text() )
+		if 'function' in error and 'does not exist' in error:
+			continue
+		estimatedExtentFunctions[ name ] = function
+		return extent
+	return None
+
+def exactExtent( d, dictOpts ):
+	""" Return the extent of a vector layer aggregated over all its geometries """
+	with timed( 'exact extent', layer=dictOpts['-s'] + '.' + dictOpts['-t'] ):
+		return queryExtent( QSqlQuery( d ), "SELECT ST_Extent( %s ) AS e FROM %s.%s%s" % ( quoteIdent( dictOpts['-g'] ),
+			quoteIdent( dictOpts['-s'] ), quoteIdent( dictOpts['-t'] ), whereClause( dictOpts ) ) )
+
+def exactCount( d, dictOpts ):
+	""" Return the number of features of a vector layer, None on error """
+	query = QSqlQuery( d )
+	with timed( 'feature count', layer=dictOpts['-s'] + '.' + dictOpts['-t'] ):
+		counted = query.exec_( "SELECT count(*) FROM %s.%s%s" % ( quoteIdent( dictOpts['-s'] ), quoteIdent( dictOpts['-t'] ),
+			whereClause( dictOpts ) ) )
+	if not counted or not query.next():
+		return None
+	return long( query.value( 0 ).toLongLong()[ 0 ] )
+
+def layerExtent( layer, dictOpts ):
+	""" Return the extent of a new layer: the cached one, the exact one of the
+		filtered rows, the estimated one if the table has statistics or the one of
+		the provider. It is kept in the metadata cache """
+	metadata = layerMetadataCache.get( dictOpts )
+	if metadata and 'extent' in metadata:
+		return QgsRectangle( *metadata['extent'] )
+
+	extent = None
+	if dictOpts['type'] == 'vector':
+		d = openConnection( dictOpts )
+		if d.isOpen() and layerFilter( dictOpts ):
+			extent = exactExtent( d, dictOpts ) # Statistics are about the whole table
+			if extent is None: # No row matches
+				extent = ( 0.0, 0.0, 0.0, 0.0 )
+			layerMetadataCache.update( dictOpts, extent=extent, extentEstimated=False )
+			return QgsRectangle( *extent )
+		if d.isOpen():
+			extent = estimatedExtent( d, dictOpts )
+	estimated = extent is not None
+	if extent is None:
+		rect = layer.extent()
+		extent = ( rect.xMinimum(), rect.yMinimum(), rect.xMaximum(), rect.yMaximum() )
+	layerMetadataCache.update( dictOpts, extent=extent, extentEstimated=estimated )
+	return QgsRectangle( *extent )
+
+def rasterConnString( dictOpts ):
+	""" Return the GDAL connection string of a raster table """
+	return "PG: dbname=%s host=%s user=%s password=%s port=%s schema=%s table=%s" % ( dictOpts['-d'], dictOpts['-h'], dictOpts['-U'], dictOpts['-W'], dictOpts['-p'], dictOpts['-s'], dictOpts['-t'] )
+
+def createRasterLayer( source, dictOpts ):
+	""" Build a raster layer of a table from a GDAL source (the table or a local copy).
+		Its nodata pixels are transparent through the nodata value GDAL reports,
+		the one of the raster metadata is set only if GDAL has none """
+	layer = QgsRasterLayer( source, dictOpts['-s'] + '.' + dictOpts['-t'] )
+	metadata = layerMetadataCache.get( dictOpts ) or {}
+	nodata = metadata.get( 'nodata' ) or [ None ]
+	if layer.isValid() and not layer.isNoDataValueValid() and nodata[ 0 ] is not None:
+		layer.setNoDataValue( nodata[ 0 ] ) # One value per layer in QGIS 1.x, the first band one
+	return layer
+
+def createLayer( dictOpts ):
+	""" Build the QGIS layer of a detected table """
+	if dictOpts['type'] == 'vector':
+		# QGIS connection
+		uri = QgsDataSourceURI()
+		uri.setConnection( dictOpts['-h'], dictOpts['-p'], dictOpts['-d'], dictOpts['-U'], dictOpts['-W'] )
+		key = '--geometry-only' in dictOpts and tableKey( dictOpts )
+		if key:
+			# Only the key and the geometry are fetched, whatever the width of the rows
+			sql = "(SELECT %s, %s FROM %s.%s%s)" % ( quoteIdent( key ), quoteIdent( dictOpts['-g'] ),
+				quoteIdent( dictOpts['-s'] ), quoteIdent( dictOpts['-t'] ), whereClause( dictOpts ) )
+			uri.setDataSource( '', sql, dictOpts['-g'], '', key )
+			layerMetadataCache.update( dictOpts, fieldCount=columnCount( openConnection( dictOpts ), dictOpts ) )
+		else:
+			if '--geometry-only' in dictOpts:
+				print 'I: %s.%s has no primary key, all its columns are fetched' % ( dictOpts['-s'], dictOpts['-t'] )
+			uri.setDataSource( dictOpts['-s'], dictOpts['-t'], dictOpts['-g'], layerFilter( dictOpts ) )
+		uri.setUseEstimatedMetadata( True ) # Do not let the provider scan the table for the extent
+		layer = QgsVectorLayer( uri.uri(), dictOpts['-s'] + '.' + dictOpts['-t'], "postgres" )		  
+	else:
+		source = None
+		if '--cache-rasters' in dictOpts:
+			source = rasterCache.path( rasterCacheKey( dictOpts ) ) # Without reading the server
+		if source is None:
+			source = rasterConnString( dictOpts )
+		if dictOpts.get( '-w' ) or dictOpts.get( '-b' ):
+			print 'I: Filters apply to vector layers only, %s.%s is shown in full' % ( dictOpts['-s'], dictOpts['-t'] )
+		layer = createRasterLayer( source, dictOpts )
+	return layer
+
+
+class LayerTask( QRunnable ):
+	""" Detect (if needed) and build the layers of one request in a loader thread """
+	def __init__( self, loader, taskId, dictOpts ):
+		QRunnable.__init__( self )
+		self.loader = loader
+		self.taskId = taskId
+		self.dictOpts = dictOpts
+		self.cancelled = False # Set from the GUI thread, checked between the steps
+
+	def run( self ):
+		try:
+			if not self.cancelled:
+				self.load( self.dictOpts )
+		finally:
+			self.loader.emit( SIGNAL( "taskFinished" ), self.taskId )
+
+	def load( self, dictOpts ):
+		if dictOpts['type'] == 'unknown': # Forwarded by a second instance, detect it here
+			d = openConnection( dictOpts )
+			if not d.isOpen():
+				self.loader.emit( SIGNAL( "layerFailed" ), "Connection error", "Error when connecting to database." )
+				return
+			layers = expandRequest( d, dictOpts )
+			if not layers:
+				self.loader.emit( SIGNAL( "layerFailed" ), "Error when opening layer",
+					"Layer '%s.%s' doesn't exist. Be sure the selected object is either raster or vector layer." % (dictOpts['-s'], dictOpts['-t']) )
+				return
+			if not self.cancelled:
+				for layerOpts in layers: # Each one gets its own task and legend entry
+					self.loader.load( layerOpts )
+			return
+
+		name = dictOpts['-s'] + '.' + dictOpts['-t']
+		with timed( 'provider', layer=name, type=dictOpts['type'] ):
+			layer = createLayer( dictOpts )
+			valid = layer.isValid()
+		lod = None
+		tiles = None
+		preview = None
+		if valid:
+			with timed( 'extent', layer=name ):
+				extent = layerExtent( layer, dictOpts )
+			if dictOpts['type'] == 'vector' and not self.cancelled:
+				if '--tiles' in dictOpts:
+					tiles = createTileSet( dictOpts )
+				if '--lod' in dictOpts and tiles is None:
+					lod = createLodLayerSet( dictOpts, extent )
+				if '--preview' in dictOpts and tiles is None and lod is None and not self.cancelled:
+					preview = createPreview( dictOpts )
+			elif layer.source().startsWith( 'PG:' ) and not self.cancelled: # Not a local copy
+				lod = createRasterOverviewSet( dictOpts )
+
+		if self.cancelled:
+			print 'I: Loading of %s.%s cancelled' % ( dictOpts['-s'], dictOpts['-t'] )
+		elif valid:
+			# Hand the layer over to the GUI thread
+			layer.moveToThread( QApplication.instance().thread() )
+			self.loader.emit( SIGNAL( "layerLoaded" ), self.taskId, dictOpts, layer, extent, lod, tiles, preview )
+		else:
+			print >> sys.stderr, 'E: Layer %s.%s is not valid' % ( dictOpts['-s'], dictOpts['-t'] )
+			layerMetadataCache.invalidate( dictOpts ) # The cached metadata could be stale
+			self.loader.emit( SIGNAL( "layerFailed" ), "Error when opening layer",
+				"Layer '%s.%s' is not valid." % ( dictOpts['-s'], dictOpts['-t'] ) )
+
+
+def primaryKey( d, dictOpts ):
+	""" Return the single column primary key of a table, '' if it has none """
+	query = QSqlQuery( d )
+	query.exec_( "SELECT a.attname FROM pg_index i \
+			JOIN pg_class c ON c.oid = i.indrelid \
+			JOIN pg_namespace n ON n.oid = c.relnamespace \
+			JOIN pg_attribute a ON a.attrelid = i.indrelid AND a.attnum = i.indkey[0] \
+		WHERE n.nspname = %s AND c.relname = %s AND i.indisprimary AND i.indnatts = 1" % (
+		quoteLiteral( dictOpts['-s'] ), quoteLiteral( dictOpts['-t'] ) ) )
+	if query.next():
+		return str( query.value( 0 ).toString() )
+	return ''
+
+def tableKey( dictOpts ):
+	""" Return the primary key of a table (see primaryKey), kept in the metadata cache """
+	key = ( layerMetadataCache.get( dictOpts ) or {} ).get( 'key' )
+	if key is None:
+		key = primaryKey( openConnection( dictOpts ), dictOpts )
+		layerMetadataCache.update( dictOpts, key=key )
+	return key
+
+def columnCount( d, dictOpts ):
+	""" Return the number of columns of a table, None if it could not be read """
+	query = QSqlQuery( d )
+	if not query.exec_( "SELECT count(*) FROM pg_attribute a \
+			JOIN pg_class c ON c.oid = a.attrelid \
+			JOIN pg_namespace n ON n.oid = c.relnamespace \
+		WHERE n.nspname = %s AND c.relname = %s AND a.attnum > 0 AND NOT a.attisdropped" % (
+		quoteLiteral( dictOpts['-s'] ), quoteLiteral( dictOpts['-t'] ) ) ) or not query.next():
+		return None
+	return query.value( 0 ).toInt()[ 0 ]
+
+def copySymbology( source, target ):
+	""" Give the target vector layer the colors of the source one """
+	sourceSymbol = source.renderer().symbols()[ 0 ]
+	targetSymbol = target.renderer().symbols()[ 0 ]
+	targetSymbol.setColor( sourceSymbol.color() )
+	targetSymbol.setFillColor( sourceSymbol.fillColor() )
+	target.setCacheImage( None )
+
+
+class LodLayerSet:
+	""" Versions of a vector layer simplified on the server, one per scale band """
+	def __init__( self, dictOpts, key, extent ):
+		self.dictOpts = dictOpts
+		self.key = key
+		base = max( extent.width(), extent.height() ) / lod_base_pixels
+		self.tolerances = [ base / ( lod_band_factor ** band ) for band in range( lod_bands ) ]
+		if base <= 0:
+			self.tolerances = []
+		self.layers = {} # Built layers by band
+		self.building = set()
+		self.failed = set()
+
+	def band( self, mapUnitsPerPixel ):
+		""" Return the band to draw at a scale, None for the full detail """
+		for band, tolerance in enumerate( self.tolerances ):
+			if tolerance <= mapUnitsPerPixel:
+				return band
+		return None
+
+	def build( self, band ):
+		""" Build the layer of a band in a loader thread and hand it to the GUI thread """
+		dictOpts = self.dictOpts
+		tolerance = '%.17g' % self.tolerances[ band ]
+		sql = "SELECT %s, ST_Simplify( ST_SnapToGrid( %s, %s ), %s ) AS %s FROM %s.%s%s" % (
+			quoteIdent( self.key ), quoteIdent( dictOpts['-g'] ), tolerance, tolerance,
+			quoteIdent( dictOpts['-g'] ), quoteIdent( dictOpts['-s'] ), quoteIdent( dictOpts['-t'] ),
+			whereClause( dictOpts ) )
+		uri = QgsDataSourceURI()
+		uri.setConnection( dictOpts['-h'], dictOpts['-p'], dictOpts['-d'], dictOpts['-U'], dictOpts['-W'] )
+		table = None
+		if '--lod-tables' in dictOpts:
+			table = materializeBand( openConnection( dictOpts ), dictOpts, self.key, band, tolerance, sql )
+		if table is not None:
+			uri.setDataSource( lod_schema, table, dictOpts['-g'], '', self.key )
+		else: # Simplified by every query of the provider
+			uri.setDataSource( '', '(' + sql + ')', dictOpts['-g'], '', self.key )
+		uri.setUseEstimatedMetadata( True )
+		layer = QgsVectorLayer( uri.uri(), dictOpts['-s'] + '.' + dictOpts['-t'], "postgres" )
+		if not layer.isValid():
+			print >> sys.stderr, 'E: Band %d of %s.%s is not valid' % ( band, dictOpts['-s'], dictOpts['-t'] )
+			return None
+		print 'I: Band %d of %s.%s simplified to %s' % ( band, dictOpts['-s'], dictOpts['-t'], tolerance )
+		layer.moveToThread( QApplication.instance().thread() )
+		return layer
+
+def materializeBand( d, dictOpts, key, band, tolerance, sql ):
+	""" Return the name of the table of lod_schema holding the rows of sql (a band of
+		a table simplified to tolerance), created with a spatial index on the first use.
+		The same band (table, filters, band and tolerance) of the previous versions of
+		the table is dropped, never a band of other filters or another tolerance. None
+		if the band can not be materialized (a view, no CREATE privilege) """
+	version = dataVersion( d, dictOpts )
+	if not version:
+		return None
+	identity = '\0'.join( [ dictOpts['-s'], dictOpts['-t'], dictOpts.get( '-w', '' ), dictOpts.get( '-b', '' ),
+		str( band ), tolerance ] ).encode( 'utf-8' )
+	prefix = 'lod_%s_' % hashlib.sha1( identity ).hexdigest()[ :20 ]
+	table = prefix + hashlib.sha1( version ).hexdigest()[ :12 ]
+	if tableExists( d, lod_schema, table ):
+		return table
+
+	schema = quoteIdent( lod_schema )
+	building = '%s_%d_%d' % ( table, os.getpid(), thread.get_ident() % 100000 ) # Renamed once complete
+	geometry = quoteIdent( dictOpts['-g'] )
+	query = QSqlQuery( d )
+	with timed( 'band', layer=dictOpts['-s'] + '.' + dictOpts['-t'], band=band ):
+		for statement in [ "CREATE SCHEMA IF NOT EXISTS %s" % schema,
+				"CREATE UNLOGGED TABLE %s.%s AS SELECT * FROM ( %s ) s WHERE %s IS NOT NULL" % (
+					schema, quoteIdent( building ), sql, geometry ),
+				"ALTER TABLE %s.%s ADD PRIMARY KEY ( %s )" % ( schema, quoteIdent( building ), quoteIdent( key ) ),
+				"CREATE INDEX ON %s.%s USING gist ( %s )" % ( schema, quoteIdent( building ), geometry ),
+				"ANALYZE %s.%s" % ( schema, quoteIdent( building ) ),
+				"ALTER TABLE %s.%s RENAME TO %s" % ( schema, quoteIdent( building ), quoteIdent( table ) ) ]:
+			if not query.exec_( statement ):
+				error = query.lastError().text()
+				query.exec_( "DROP TABLE IF EXISTS %s.%s" % ( schema, quoteIdent( building ) ) )
+				if tableExists( d, lod_schema, table ): # Built by another viewer meanwhile
+					return table
+				print >> sys.stderr, 'E: Band %d of %s.%s not materialized: %s' % ( band, dictOpts['-s'],
+					dictOpts['-t'], error )
+				return None
+
+	query.exec_( "SELECT c.relname FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace \
+		WHERE n.nspname = %s AND substr( c.relname, 1, %d ) = %s AND substr( c.relname, 1, %d ) <> %s \
+		AND c.relkind = 'r'" % ( quoteLiteral( lod_schema ), len( prefix ), quoteLiteral( prefix ), len( table ),
+		quoteLiteral( table ) ) ) # Older versions, not this one being built by another viewer
+	stale = []
+	while query.next():
+		stale.append( unicode( query.value( 0 ).toString() ) )
+	for old in stale:
+		query.exec_( "DROP TABLE IF EXISTS %s.%s" % ( schema, quoteIdent( old ) ) )
+	return table
+
+def tableExists( d, schema, table ):
+	query = QSqlQuery( d )
+	query.exec_( "SELECT 1 FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace \
+		WHERE n.nspname = %s AND c.relname = %s" % ( quoteLiteral( schema ), quoteLiteral( table ) ) )
+	return query.next()
+
+def createLodLayerSet( dictOpts, extent ):
+	""" Return the LodLayerSet of a new layer with its coarsest band built, or
+		None if the layer can not be generalized (points, no primary key) """
+	metadata = layerMetadataCache.get( dictOpts ) or {}
+	if metadata.get( 'geometryType', '' ).upper() in ( 'POINT', 'MULTIPOINT' ):
+		return None
+	key = tableKey( dictOpts )
+	if not key:
+		print 'I: %s.%s has no primary key, it is drawn in full detail' % ( dictOpts['-s'], dictOpts['-t'] )
+		return None
+
+	lod = LodLayerSet( dictOpts, key, extent )
+	if lod.tolerances:
+		layer = lod.build( 0 )
+		if layer is not None:
+			lod.layers[ 0 ] = layer
+	return lod
+
+
+class RasterOverviewSet:
+	""" Overview tables of a raster (raster2pgsql -l), drawn like the bands of a LodLayerSet """
+	def __init__( self, dictOpts, pixelSize, overviews ):
+		self.dictOpts = dictOpts
+		self.pixelSize = pixelSize # Of the raster itself
+		self.overviews = overviews # ( factor, schema, table ), coarsest first
+		self.layers = {} # Built layers by band (index of the overview)
+		self.building = set()
+		self.failed = set()
+
+	def band( self, mapUnitsPerPixel ):
+		""" Return the coarsest overview with at least a pixel per screen pixel, None for the raster """
+		for band, ( factor, schema, table ) in enumerate( self.overviews ):
+			if self.pixelSize * factor <= mapUnitsPerPixel:
+				return band
+		return None
+
+	def build( self, band ):
+		""" Build the layer of an overview in a loader thread and hand it to the GUI thread """
+		factor, schema, table = self.overviews[ band ]
+		layer = createRasterLayer( rasterConnString( dict( self.dictOpts, **{ '-s': schema, '-t': table } ) ),
+			self.dictOpts )
+		if not layer.isValid():
+			print >> sys.stderr, 'E: Overview %s.%s is not valid' % ( schema, table )
+			return None
+		print 'I: Overview %s.%s (factor %d) opened' % ( schema, table, factor )
+		layer.moveToThread( QApplication.instance().thread() )
+		return layer
+
+def createRasterOverviewSet( dictOpts ):
+	""" Return the RasterOverviewSet of a raster, None if it has no overviews """
+	metadata = layerMetadataCache.get( dictOpts ) or {}
+	column = metadata.get( 'column' )
+	if not column:
+		return None
+	d = openConnection( dictOpts )
+	query = QSqlQuery( d )
+	if not query.exec_( "SELECT overview_factor, o_table_schema, o_table_name FROM raster_overviews \
+		WHERE r_table_schema = %s AND r_table_name = %s AND r_raster_column = %s \
+		ORDER BY overview_factor DESC" % ( quoteLiteral( dictOpts['-s'] ), quoteLiteral( dictOpts['-t'] ),
+		quoteLiteral( column ) ) ):
+		return None
+	overviews = []
+	while query.next():
+		overviews.append( ( query.value( 0 ).toInt()[ 0 ], unicode( query.value( 1 ).toString() ),
+			unicode( query.value( 2 ).toString() ) ) )
+	if not overviews:
+		return None
+
+	query.exec_( "SELECT abs( ST_ScaleX( %s ) ) FROM %s.%s LIMIT 1" % ( quoteIdent( column ),
+		quoteIdent( dictOpts['-s'] ), quoteIdent( dictOpts['-t'] ) ) )
+	if not query.next():
+		return None
+	pixelSize = query.value( 0 ).toDouble()[ 0 ]
+	print 'I: %d overviews found for %s.%s' % ( len( overviews ), dictOpts['-s'], dictOpts['-t'] )
+	overviewSet = RasterOverviewSet( dictOpts, pixelSize, overviews )
+	layer = overviewSet.build( 0 ) # Likely drawn first, with the whole raster in view
+	if layer is not None:
+		overviewSet.layers[ 0 ] = layer
+	return overviewSet
+
+
+def dataVersion( d, dictOpts ):
+	""" Return a text changing whenever the rows of a table change, '' if it can
+		not be known (e.g. views). It is based on the relation file and the row
+		statistics, so it lags behind a commit for the statistics delay """
+	query = QSqlQuery( d )
+	query.exec_( "SELECT c.relfilenode, s.n_tup_ins, s.n_tup_upd, s.n_tup_del FROM pg_class c \
+			JOIN pg_namespace n ON n.oid = c.relnamespace \
+			JOIN pg_stat_all_tables s ON s.relid = c.oid \
+		WHERE n.nspname = %s AND c.relname = %s AND c.relkind = 'r'" % (
+		quoteLiteral( dictOpts['-s'] ), quoteLiteral( dictOpts['-t'] ) ) )
+	if query.next():
+		return '-'.join( [ str( query.value( i ).toString() ) for i in range( 4 ) ] )
+	return ''
+
+class Preview:
+	""" Sample of a huge vector layer, drawn at every view before the full layer """
+	def __init__( self, layer ):
+		self.layer = layer
+		self.state = 'sample' # Then 'refining' while the full layer is drawn, 'refined' once drawn
+
+def serverVersion( d ):
+	""" Return the version number of the server (e.g. 90500), 0 if unknown """
+	query = QSqlQuery( d )
+	if query.exec_( "SHOW server_version_num" ) and query.next():
+		return query.value( 0 ).toString().toInt()[ 0 ]
+	return 0
+
+def createPreview( dictOpts ):
+	""" Return the Preview of a new vector layer, None if the table is small enough
+		or can not be sampled (no primary key) """
+	metadata = layerMetadataCache.get( dictOpts ) or {}
+	rows = metadata.get( 'estimatedRows', -1 )
+	if rows < preview_min_rows:
+		return None
+	key = tableKey( dictOpts )
+	if not key:
+		print 'I: %s.%s has no primary key, it is not previewed' % ( dictOpts['-s'], dictOpts['-t'] )
+		return None
+
+	table = "%s.%s" % ( quoteIdent( dictOpts['-s'] ), quoteIdent( dictOpts['-t'] ) )
+	fraction = float( preview_rows ) / rows
+	if serverVersion( openConnection( dictOpts ) ) >= 90500:
+		# Whole pages, the same ones for every view
+		source = "%s TABLESAMPLE SYSTEM (%.6g) REPEATABLE (0)%s" % ( table, 100 * fraction, whereClause( dictOpts ) )
+	else: # Needs an integer key
+		source = "%s WHERE %s %% %d = 0" % ( table, quoteIdent( key ), int( round( 1 / fraction ) ) )
+		if layerFilter( dictOpts ):
+			source += " AND " + layerFilter( dictOpts )
+	sql = "(SELECT %s, %s FROM %s)" % ( quoteIdent( key ), quoteIdent( dictOpts['-g'] ), source )
+	uri = QgsDataSourceURI()
+	uri.setConnection( dictOpts['-h'], dictOpts['-p'], dictOpts['-d'], dictOpts['-U'], dictOpts['-W'] )
+	uri.setDataSource( '', sql, dictOpts['-g'], '', key )
+	uri.setUseEstimatedMetadata( True )
+	layer = QgsVectorLayer( uri.uri(), dictOpts['-s'] + '.' + dictOpts['-t'], "postgres" )
+	if not layer.isValid():
+		print >> sys.stderr, 'E: Sample of %s.%s is not valid' % ( dictOpts['-s'], dictOpts['-t'] )
+		return None
+	print 'I: %s.%s previewed with a sample of about %d rows' % ( dictOpts['-s'], dictOpts['-t'], preview_rows )
+	layer.moveToThread( QApplication.instance().thread() )
+	return Preview( layer )
+
+# Memory provider geometry types of the PostGIS ones
+memoryGeometryTypes = { 'POINT': 'Point', 'LINESTRING': 'LineString', 'POLYGON': 'Polygon',
+	'MULTIPOINT': 'MultiPoint', 'MULTILINESTRING': 'MultiLineString', 'MULTIPOLYGON': 'MultiPolygon' }
+
+class TileLevel:
+	""" Tiles of a zoom level and the memory layer holding their features """
+	def __init__( self, level, layer ):
+		self.level = level
+		self.layer = layer
+		self.requested = set() # Addresses of the tiles fetched or being fetched
+		self.keys = set() # Keys of the features in the layer
+		self.pending = 0
+		self.prefetching = set() # Addresses of the tiles being prefetched
+		self.wanted = set() # Tiles being prefetched that came into view
+		self.prefetched = collections.OrderedDict() # Address -> features of the prefetched tiles
+
+class TileSet:
+	""" Tile grid of a vector layer loaded in tile mode """
+	def __init__( self, dictOpts, key, geometryType, version ):
+		self.dictOpts = dictOpts
+		self.key = key
+		self.geometryType = geometryType
+		self.version = version # Tiles are cached on disk only if known
+		self.drawn = None # TileLevel drawn on the map
+		self.loading = None # TileLevel of the current scale, the drawn one once complete
+
+	def layers( self ):
+		return [ tileLevel.layer for tileLevel in set( [ self.drawn, self.loading ] ) if tileLevel is not None ]
+
+	def levelFor( self, mapUnitsPerPixel ):
+		""" Return the level whose tiles are about tile_pixels wide at a scale """
+		return int( math.ceil( math.log( tile_pixels * mapUnitsPerPixel, 2 ) ) )
+
+	def addresses( self, extent, level ):
+		""" Return the addresses of the tiles of a level covering extent """
+		size = 2.0 ** level
+		xs = range( int( math.floor( extent.xMinimum() / size ) ), int( math.floor( extent.xMaximum() / size ) ) + 1 )
+		ys = range( int( math.floor( extent.yMinimum() / size ) ), int( math.floor( extent.yMaximum() / size ) ) + 1 )
+		return [ ( x, y ) for x in xs for y in ys ]
+
+	def ringAddresses( self, extent, level, direction, visible ):
+		""" Return the addresses of the tiles around the visible ones, widened by
+			prefetch_ahead tiles in direction, the tiles ahead first """
+		size = 2.0 ** level
+		dx, dy = direction
+		ring = QgsRectangle( extent.xMinimum() - size * ( 1 + prefetch_ahead * ( dx < 0 ) ),
+			extent.yMinimum() - size * ( 1 + prefetch_ahead * ( dy < 0 ) ),
+			extent.xMaximum() + size * ( 1 + prefetch_ahead * ( dx > 0 ) ),
+			extent.yMaximum() + size * ( 1 + prefetch_ahead * ( dy > 0 ) ) )
+		visible = set( visible )
+		cx = extent.center().x() / size
+		cy = extent.center().y() / size
+		return sorted( [ address for address in self.addresses( ring, level ) if not address in visible ],
+			key=lambda ( x, y ): -( dx * ( x + 0.5 - cx ) + dy * ( y + 0.5 - cy ) ) )
+
+	def cacheKey( self, level, x, y ):
+		d = self.dictOpts
+		return '\0'.join( [ d['-h'], d['-p'], d['-d'], d['-s'], d['-t'], d['-g'], d.get( '-w', '' ), d.get( '-b', '' ),
+			self.version, str( level ), str( x ), str( y ) ] ).encode( 'utf-8' )
+
+def createTileSet( dictOpts ):
+	""" Return the TileSet of a new layer, None if it can not be loaded by tiles
+		(no primary key to merge the features fetched with several tiles) """
+	metadata = layerMetadataCache.get( dictOpts ) or {}
+	geometryType = metadata.get( 'geometryType', '' ).upper()
+	if not geometryType in memoryGeometryTypes:
+		print 'I: %s.%s has no fixed geometry type, it is not loaded by tiles' % ( dictOpts['-s'], dictOpts['-t'] )
+		return None
+	key = tableKey( dictOpts )
+	if not key:
+		print 'I: %s.%s has no primary key, it is not loaded by tiles' % ( dictOpts['-s'], dictOpts['-t'] )
+		return None
+	return TileSet( dictOpts, key, geometryType, dataVersion( openConnection( dictOpts ), dictOpts ) )
+
+def createTileLayer( tiles ):
+	""" Build the empty memory layer of a tile level """
+	dictOpts = tiles.dictOpts
+	return QgsVectorLayer( "%s?crs=epsg:%s" % ( memoryGeometryTypes[ tiles.geometryType ], dictOpts['srid'] ),
+		dictOpts['-s'] + '.' + dictOpts['-t'], "memory" )
+
+tile_record = struct.Struct( '>II' )
+
+def encodeTile( rows ):
+	""" Return the cached form of the ( key, WKB ) rows of a tile """
+	parts = []
+	for key, wkb in rows:
+		key = key.encode( 'utf-8' )
+		parts.append( tile_record.pack( len( key ), len( wkb ) ) + key + wkb )
+	return ''.join( parts )
+
+def decodeTile( data ):
+	rows = []
+	offset = 0
+	while offset < len( data ):
+		keySize, wkbSize = tile_record.unpack_from( data, offset )
+		offset += tile_record.size
+		rows.append( ( data[ offset:offset + keySize ].decode( 'utf-8' ),
+			data[ offset + keySize:offset + keySize + wkbSize ] ) )
+		offset += keySize + wkbSize
+	return rows
+
+def fetchTile( tiles, level, x, y ):
+	""" Return the ( key, feature ) of a tile from the disk cache or the database,
+		None if the query failed """
+	cacheKey = tiles.cacheKey( level, x, y )
+	data = None
+	if tiles.version:
+		data = tileCache.get( cacheKey )
+
+	if data is None:
+		dictOpts = tiles.dictOpts
+		size = 2.0 ** level
+		geometry = quoteIdent( dictOpts['-g'] )
+		if not 'POINT' in tiles.geometryType:
+			geometry = "ST_Simplify( %s, %.17g )" % ( geometry, size / tile_pixels )
+		condition = layerFilter( dictOpts )
+		query = QSqlQuery( openConnection( dictOpts ) )
+		if not query.exec_( "SELECT %s::text, encode( ST_AsBinary( %s ), 'base64' ) FROM %s.%s \
+			WHERE %s && ST_SetSRID( ST_MakeBox2D( ST_Point( %.17g, %.17g ), ST_Point( %.17g, %.17g ) ), %s )%s" % (
+			quoteIdent( tiles.key ), geometry, quoteIdent( dictOpts['-s'] ), quoteIdent( dictOpts['-t'] ),
+			quoteIdent( dictOpts['-g'] ), x * size, y * size, ( x + 1 ) * size, ( y + 1 ) * size, dictOpts['srid'],
+			condition and " AND " + condition ) ):
+			print >> sys.stderr, 'E: Tile of %s.%s failed: %s' % ( dictOpts['-s'], dictOpts['-t'],
+				query.lastError().text() )
+			return None
+		rows = []
+		while query.next():
+			if not query.isNull( 1 ): # Collapsed by the simplification
+				rows.append( ( unicode( query.value( 0 ).toString() ),
+					base64.b64decode( str( query.value( 1 ).toString() ) ) ) )
+		data = encodeTile( rows )
+		if tiles.version:
+			tileCache.put( cacheKey, data )
+
+	features = []
+	for key, wkb in decodeTile( data ):
+		geometry = QgsGeometry()
+		geometry.fromWkb( wkb )
+		feature = QgsFeature()
+		feature.setGeometry( geometry )
+		features.append( ( key, feature ) )
+	return features
+
+
+def rasterCacheKey( dictOpts ):
+	""" Return the key of the local copy of a raster, changing with its data """
+	return '\0'.join( [ dictOpts['-h'], dictOpts['-p'], dictOpts['-d'], dictOpts['-s'], dictOpts['-t'],
+		dataVersion( openConnection( dictOpts ), dictOpts ) ] ).encode( 'utf-8' )
+
+def createRasterCopy( dictOpts ):
+	""" Copy a raster to a local tiled GeoTIFF with overviews, add it to the raster
+		cache and return a layer reading it. Return None if it can not be cached """
+	key = rasterCacheKey( dictOpts )
+	if key.endswith( '\0' ): # No data version, e.g. a view
+		return None
+	source = gdal.Open( rasterConnString( dictOpts ) )
+	if source is None or source.RasterCount == 0:
+		return None
+	bandSizes = [ gdal.GetDataTypeSize( source.GetRasterBand( i + 1 ).DataType ) / 8 for i in range( source.RasterCount ) ]
+	size = source.RasterXSize * source.RasterYSize * sum( bandSizes )
+	if size * 4 / 3 > raster_cache_size / 2: # With its overviews
+		print 'I: Raster %s.%s is too large to be cached' % ( dictOpts['-s'], dictOpts['-t'] )
+		return None
+
+	print 'I: Caching raster %s.%s ...' % ( dictOpts['-s'], dictOpts['-t'] )
+	tmpPath = rasterCache.tempPath( key )
+	# Uncompressed, so that it can be memory mapped
+	copy = gdal.GetDriverByName( 'GTiff' ).CreateCopy( tmpPath, source, 0, [ 'TILED=YES', 'BIGTIFF=IF_SAFER' ] )
+	if copy is None:
+		if os.path.exists( tmpPath ):
+			os.remove( tmpPath )
+		return None
+	nodata = ( layerMetadataCache.get( dictOpts ) or {} ).get( 'nodata' ) or []
+	for i, value in enumerate( nodata[ :copy.RasterCount ] ):
+		band = copy.GetRasterBand( i + 1 )
+		if value is not None and band.GetNoDataValue() is None: # Keep the per band values in the copy
+			band.SetNoDataValue( value )
+	factors = []
+	factor = 2
+	while max( source.RasterXSize, source.RasterYSize ) / factor >= 256:
+		factors.append( factor )
+		factor *= 2
+	if factors:
+		copy.BuildOverviews( 'NEAREST', factors )
+	copy = None # Close the file
+	rasterCache.add( key, tmpPath )
+
+	layer = createRasterLayer( rasterCache.path( key ), dictOpts )
+	if not layer.isValid():
+		return None
+	layer.moveToThread( QApplication.instance().thread() )
+	return layer
+
+
+def rasterThumbnail( dictOpts, source ):
+	""" Return the legend thumbnail ( a QImage ) of a raster rendered from a GDAL
+		source, cached by table and data version. None if it can not be rendered """
+	key = rasterCacheKey( dictOpts )
+	versioned = not key.endswith( '\0' ) # Not a view
+	key += '\0thumbnail'
+	data = None
+	if versioned:
+		data = thumbnailCache.get( key )
+	if data is not None:
+		image = QImage()
+		if image.loadFromData( data, "PNG" ):
+			return image
+
+	layer = createRasterLayer( source, dictOpts )
+	if not layer.isValid():
+		return None
+	image = QImage( thumbnail_size, thumbnail_size, QImage.Format_ARGB32 )
+	image.fill( 0 )
+	layer.thumbnailAsImage( image ) # QImage, unlike QPixmap, can be painted outside the GUI thread
+	if versioned:
+		png = QByteArray()
+		buf = QBuffer( png )
+		buf.open( QIODevice.WriteOnly )
+		image.save( buf, "PNG" )
+		buf.close()
+		thumbnailCache.put( key, str( png ) )
+	return image
+
+
+class CallTask( QRunnable ):
+	""" Call a function in a loader thread and hand its result to the GUI thread """
+	def __init__( self, loader, function, callback, args ):
+		QRunnable.__init__( self )
+		self.setAutoDelete( False ) # Deleted with the Python object after the callback
+		self.loader = loader
+		self.function = function
+		self.callback = callback
+		self.args = args
+
+	def run( self ):
+		result = None
+		try:
+			result = self.function()
+		finally:
+			self.loader.emit( SIGNAL( "callFinished" ), self, result )
+
+
+class LayerLoader( QObject ):
+	"""
+	  Detect and build layers on a bounded pool of threads. Every layer is
+	  emitted with SIGNAL( "layerLoaded" ) and the id of its task in the GUI
+	  thread as soon as it is ready (see isCancelled), errors with
+	  SIGNAL( "layerFailed" ). Queued tasks are announced
+	  with SIGNAL( "taskQueued" ) and end with SIGNAL( "taskFinished" ), or
+	  SIGNAL( "taskCancelled" ) as soon as they are cancelled
+	"""
+	def __init__( self, parent, maxThreads ):
+		QObject.__init__( self, parent )
+		self.pool = QThreadPool( self )
+		self.pool.setMaxThreadCount( maxThreads )
+		self.pool.setExpiryTimeout( -1 ) # Keep the threads, and so their connections
+		self.longPool = QThreadPool( self ) # Long tasks, not to hold the threads of the others
+		self.longPool.setMaxThreadCount( 1 )
+		self.tasks = {}
+		self.calls = set()
+		self.lastTaskId = 0
+		self.lock = threading.Lock()
+		self.connect( self, SIGNAL( "taskFinished" ), self.taskFinished )
+		self.connect( self, SIGNAL( "callFinished" ), self.callFinished )
+
+	def load( self, dictOpts ):
+		""" Queue a request, it can be called from any thread """
+		self.lock.acquire()
+		self.lastTaskId += 1
+		task = LayerTask( self, self.lastTaskId, dictOpts )
+		task.setAutoDelete( False )
+		self.tasks[ task.taskId ] = task # Keep the Python object alive while it runs
+		self.lock.release()
+		self.emit( SIGNAL( "taskQueued" ), task.taskId, dictOpts['-s'] + '.' + dictOpts['-t'] )
+		self.pool.start( task )
+
+	def run( self, function, callback, *args ):
+		""" Call function() on a pool thread, then callback( result, *args ) in the GUI thread """
+		task = CallTask( self, function, callback, args )
+		self.lock.acquire()
+		self.calls.add( task ) # Keep the Python object alive while it runs
+		self.lock.release()
+		self.pool.start( task )
+
+	def prefetch( self, function, callback, *args ):
+		""" Like run, but the call waits for the threads to be free of the other tasks """
+		task = CallTask( self, function, callback, args )
+		self.lock.acquire()
+		self.calls.add( task )
+		self.lock.release()
+		self.pool.start( task, -1 )
+
+	def runLong( self, function, callback, *args ):
+		""" Like run, for a call lasting minutes (e.g. a raster copy): the calls run one
+			at a time on a thread of their own """
+		task = CallTask( self, function, callback, args )
+		self.lock.acquire()
+		self.calls.add( task )
+		self.lock.release()
+		self.longPool.start( task )
+
+	def callFinished( self, task, result ):
+		self.lock.acquire()
+		self.calls.discard( task )
+		self.lock.release()
+		task.callback( result, *task.args )
+
+	def cancel( self, taskId ):
+		""" Drop a queued or running task, a layer it is building is discarded """
+		self.lock.acquire()
+		task = self.tasks.get( taskId )
+		self.lock.release()
+		if task is not None:
+			task.cancelled = True
+			self.emit( SIGNAL( "taskCancelled" ), taskId )
+
+	def isCancelled( self, taskId ):
+		""" Return True if a task was cancelled, until its SIGNAL( "taskFinished" ) is handled """
+		self.lock.acquire()
+		task = self.tasks.get( taskId )
+		self.lock.release()
+		return task is not None and task.cancelled
+
+	def cancelAll( self ):
+		""" Drop every queued or running task """
+		self.lock.acquire()
+		taskIds = self.tasks.keys()
+		self.lock.release()
+		for taskId in taskIds:
+			self.cancel( taskId )
+
+	def taskFinished( self, taskId ):
+		self.lock.acquire()
+		self.tasks.pop( taskId, None )
+		self.lock.release()
+
+	def isIdle( self ):
+		""" Return True if no layer is being loaded and no call is running """
+		self.lock.acquire()
+		idle = not self.tasks and not self.calls
+		self.lock.release()
+		return idle
+
+
+class NavigationBenchmark( QObject ):
+	"""
+	  Time the first frame with every layer loaded and then a scripted zoom
+	  and pan sequence, each step from the extent change to its rendered frame,
+	  and quit (--benchmark, used by postgis_viewer_bench.py). The times are
+	  reported as --profile records
+	"""
+	# Name, extent scale and shift as a fraction of the extent width and height
+	steps = [ ( 'zoom in', 0.5, 0, 0 ), ( 'pan east', 1, 0.5, 0 ), ( 'pan north', 1, 0, 0.5 ),
+		( 'zoom out', 2, 0, 0 ), ( 'zoom out', 2, 0, 0 ) ]
+
+	def __init__( self, wnd ):
+		QObject.__init__( self, wnd )
+		self.wnd = wnd
+		self.start = time.time()
+		self.step = None # Running step, None until the first frame
+		self.stepStart = None
+		self.connect( wnd.refresher, SIGNAL( "rendered" ), self.rendered )
+		self.connect( wnd.loader, SIGNAL( "layerFailed" ), self.failed )
+
+	def rendered( self ):
+		if self.wnd.canvas.layerCount() == 0 or not self.wnd.loader.isIdle(): # Still loading
+			return
+		now = time.time()
+		if self.step is None:
+			postgis_viewer_profile.record( 'first frame', now - self.start, layers=self.wnd.canvas.layerCount() )
+			self.step = 0
+		elif self.stepStart is not None:
+			postgis_viewer_profile.record( 'navigation', now - self.stepStart, step=self.steps[ self.step ][ 0 ] )
+			self.step += 1
+		else: # A late frame of the previous step
+			return
+
+		if self.step == len( self.steps ):
+			QApplication.instance().quit()
+			return
+		self.stepStart = None
+		QTimer.singleShot( 0, self.runStep )
+
+	def runStep( self ):
+		name, scale, dx, dy = self.steps[ self.step ]
+		extent = QgsRectangle( self.wnd.canvas.extent() )
+		extent.scale( scale )
+		width = extent.width()
+		height = extent.height()
+		extent = QgsRectangle( extent.xMinimum() + dx * width, extent.yMinimum() + dy * height,
+			extent.xMaximum() + dx * width, extent.yMaximum() + dy * height )
+		self.stepStart = time.time()
+		self.wnd.refresher.schedule()
+		self.wnd.canvas.setExtent( extent )
+
+	def failed( self, title, text ):
+		print >> sys.stderr, 'E: Benchmark aborted: %s' % text
+		QApplication.instance().exit( 1 )
+
+
+def show_error(title, text):
+	QMessageBox.critical(None, title, text,
+	QMessageBox.Ok | QMessageBox.Default,
+	QMessageBox.NoButton)
+	print >> sys.stderr, 'E: Error. Exiting ...'
+	sys.exit(1)
+
+
+def startViewer( app, layers, report, idleTimeout=None, acknowledgeOnly=False ):
+	""" Init QGIS and run the viewer. Without idleTimeout the window is shown
+		with the given layers, otherwise it waits hidden as a daemon (loading
+		nothing with acknowledgeOnly) """
+	# QGIS libs init
+	QgsApplication.setPrefixPath(qgis_prefix, True)
+	QgsApplication.initQgis()
+	report.phase( 'initQgis' )
+
+	# Render every layer to its own cached image, so that toggling and reordering
+	# layers only composes the images again. The renderer clears the images when
+	# the extent or the canvas size change. Stored in our own settings, not QGIS ones
+	app.setOrganizationName( 'postgis_viewer' )
+	app.setApplicationName( 'postgis_viewer' )
+	QSettings().setValue( "/qgis/enable_render_caching", True )
+
+	# Open viewer
+	wnd = ViewerWnd( app, layers )
+	if layers and '--benchmark' in layers[ 0 ]:
+		benchmark = NavigationBenchmark( wnd )
+	wnd.move(100,100)
+	wnd.resize(400, 500)
+	if idleTimeout is None:
+		wnd.show()
+		report.phase( 'window' )
+		report.report( 'viewer' )
+	else:
+		report.phase( 'window' )
+		report.report( 'daemon' )
+		print 'I: Waiting for layers as a daemon ...'
+		app.setQuitOnLastWindowClosed( False )
+		wnd.setDaemonMode( idleTimeout, acknowledgeOnly )
+
+	retval = app.exec_()
+
+	# Exit
+	QgsApplication.exitQgis()
+	print 'I: Exiting ...'
+	sys.exit(retval)	  
+
+
+def main( dictOpts, report ):
+	""" Start the viewer for the options parsed by the launcher """
+	app = SingletonApp( sys.argv )
+
+	if app.is_running:
+		# Another instance started meanwhile, let it load the layer
+		if not '--daemon' in dictOpts:
+			try:
+				app.send_message( dictOpts )
+			except Exception, e:
+				print >> sys.stderr, 'E: Request not forwarded to the running viewer: %s' % e
+				sys.exit( 1 )
+		return
+
+	if '--cache-rasters' in dictOpts and gdal is None:
+		print 'I: GDAL Python bindings not found, rasters are not cached'
+
+	if '--daemon' in dictOpts:
+		startViewer( app, [], report, int( dictOpts['--idle-timeout'] ), '--benchmark' in dictOpts )
+
+	d = openConnection( dictOpts )
+
+	if d.isOpen():
+		layers = expandRequest( d, dictOpts )
+		if layers: # The objects are layers
+			startViewer( app, layers, report )
+		else:
+			show_error("Error when opening layer", 
+				"Layer '%s.%s' doesn't exist. Be sure the selected object is either raster or vector layer." % (dictOpts['-s'], dictOpts['-t']))
+	else:
+		show_error("Connection error", "Error when connecting to database.")
@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+"""
+IPC between postgis_viewer instances. It only needs QtCore and QtNetwork, so a
+second instance can forward its request to the running viewer without loading
+QtGui or the QGIS libraries.
+
+Messages are framed as a 4 byte big-endian payload length followed by a JSON
+payload. A client sends { "version": 1, "requests": [ <options>, ... ] } and
+the server answers { "version": 1, "status": "ok" } or, if the message can not
+be accepted, { "version": 1, "status": "error", "error": <text> }.
+"""
+
+import os, sys, time
+import getpass, json, struct
+
+from PyQt4.QtCore import QCoreApplication, QObject, QSharedMemory, QIODevice, SIGNAL
+from PyQt4.QtNetwork import QLocalServer, QLocalSocket
+
+from postgis_viewer_profile import timed, record
+
+timeout = 1000
+# The viewer acknowledges from its GUI thread, which may be busy drawing a layer
+ack_timeout = 30000
+protocol_version = 1
+max_frame_size = 16 * 1024 * 1024
+frame_header = struct.Struct('>I')
+# Options every layer request carries (see postgis_viewer.py)
+request_options = ('-h', '-p', '-U', '-W', '-d', '-s', '-t', '-g', 'type', 'srid')
+
+def generate_ipc_id(channel=None):
+	if channel is None:
+		channel = os.path.basename(sys.argv[0])
+	return "%s_%s" % (channel, getpass.getuser())
+
+def socket_filename():
+	""" Name of the local socket, also used as the key of the shared memory """
+	return unicode(os.path.expanduser("~/.ipc_%s" % generate_ipc_id()))
+
+def is_running():
+	""" Check if a viewer instance is already running for this user """
+	shared_mem = QSharedMemory()
+	shared_mem.setKey(socket_filename())
+	if shared_mem.attach():
+		shared_mem.detach()
+		return True
+	return False
+
+def encode_frame(message):
+	""" Return the framed bytes of a message """
+	payload = json.dumps(message)
+	return frame_header.pack(len(payload)) + payload
+
+
+class FrameReader:
+	""" Collect incoming bytes and split them into decoded messages """
+	def __init__(self):
+		self.buffer = ''
+
+	def feed(self, data):
+		""" Add data and return the list of messages completed by it """
+		self.buffer += data
+		messages = []
+		while len(self.buffer) >= frame_header.size:
+			(size,) = frame_header.unpack(self.buffer[:frame_header.size])
+			if size > max_frame_size:
+				raise ValueError("Frame of %d bytes is too large" % size)
+			end = frame_header.size + size
+			if len(self.buffer) < end:
+				break
+			payload = self.buffer[frame_header.size:end]
+			self.buffer = self.buffer[end:]
+			messages.append(json.loads(payload))
+		return messages
+
+
+def check_request(request):
+	""" Return why a received layer request can not be loaded, None if it can """
+	if not isinstance(request, dict):
+		return "Request is not an object"
+	for option in request_options:
+		if not isinstance(request.get(option), basestring):
+			return "Request without %s" % option
+	return None
+
+
+def send_message(*requests):
+	""" Send one or more layer requests to the running instance in a single
+		message and wait for its acknowledgement """
+	# Local sockets need an application object, a core one is enough
+	app = QCoreApplication.instance()
+	if app is None:
+		app = QCoreApplication(sys.argv)
+	with timed('ipc send', requests=len(requests)):
+		socket = QLocalSocket()
+		socket.connectToServer(socket_filename(), QIODevice.ReadWrite)
+		if not socket.waitForConnected(timeout):
+			raise Exception(str(socket.errorString()))
+		socket.write(encode_frame({'version': protocol_version, 'requests': list(requests)}))
+		if not socket.waitForBytesWritten(timeout):
+			raise Exception(str(socket.errorString()))
+
+		reader = FrameReader()
+		replies = []
+		while not replies:
+			if not socket.waitForReadyRead(ack_timeout):
+				raise Exception("No acknowledgement from the viewer: %s" % socket.errorString())
+			replies = reader.feed(str(socket.readAll()))
+		socket.disconnectFromServer()
+
+	if replies[0].get('status') != 'ok':
+		raise Exception("Viewer refused the request: %s" % replies[0].get('error'))
+
+
+class MessageServer(QObject):
+	"""
+	  Receive framed messages without blocking: data is read as it arrives
+	  through readyRead and every request of a complete message is emitted
+	  as SIGNAL("requestReceived")
+	"""
+	def __init__(self, parent=None):
+		QObject.__init__(self, parent)
+		self.readers = {}
+		self.starts = {} # Time a socket was accepted or its previous message received
+		self.server = QLocalServer(self)
+		self.connect(self.server, SIGNAL("newConnection()"), self.accept_connections)
+
+	def listen(self, name):
+		# if socket file exists, delete it
+		QLocalServer.removeServer(name)
+		return self.server.listen(name)
+
+	def accept_connections(self):
+		while self.server.hasPendingConnections():
+			socket = self.server.nextPendingConnection()
+			self.readers[socket] = FrameReader()
+			self.starts[socket] = time.time()
+			self.connect(socket, SIGNAL("readyRead()"), self.read_socket)
+			self.connect(socket, SIGNAL("disconnected()"), self.drop_socket)
+			if socket.bytesAvailable():
+				self.read_socket(socket)
+
+	def read_socket(self, socket=None):
+		if socket is None:
+			socket = self.sender()
+		reader = self.readers.get(socket)
+		if reader is None:
+			return
+		try:
+			messages = reader.feed(str(socket.readAll()))
+		except ValueError, e:
+			self.reply(socket, str(e))
+			socket.disconnectFromServer()
+			return
+		for message in messages:
+			if not isinstance(message, dict) or message.get('version') != protocol_version:
+				self.reply(socket, "Unsupported protocol version")
+				continue
+			requests = message.get('requests')
+			if not isinstance(requests, list):
+				self.reply(socket, "Requests are not a list")
+				continue
+			errors = filter(None, [check_request(request) for request in requests])
+			if errors:
+				self.reply(socket, errors[0])
+				continue
+			self.reply(socket)
+			for request in requests:
+				self.emit(SIGNAL("requestReceived"), request)
+			now = time.time()
+			record('ipc receive', now - self.starts.get(socket, now), requests=len(requests))
+			self.starts[socket] = now
+
+	def reply(self, socket, error=None):
+		if error is None:
+			reply = {'version': protocol_version, 'status': 'ok'}
+		else:
+			print >>sys.stderr, "E: IPC message refused: %s" % error
+			reply = {'version': protocol_version, 'status': 'error', 'error': error}
+		socket.write(encode_frame(reply))
+		socket.flush()
+
+	def drop_socket(self):
+		socket = self.sender()
+		if socket in self.readers:
+			del self.readers[socket]
+		self.starts.pop(socket, None)
+		socket.deleteLater()
@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+"""
+Phase timings of postgis_viewer (--profile). While disabled, timing a phase
+costs a flag test; once enabled, every timed phase is printed as a JSON record
+with its name, duration, thread and context (layer, database, ...) and, with
+--profile-file, appended to a file as JSON lines. It needs neither Qt nor QGIS.
+"""
+
+import time, json
+import thread, threading
+
+enabled = False
+fileName = ''
+lock = threading.Lock() # Phases are timed on the loader threads too
+
+def enable( profileFile='' ):
+	""" Start recording the phases, also to profileFile if given """
+	global enabled, fileName
+	enabled = True
+	if profileFile:
+		fileName = profileFile
+
+def record( phase, seconds, **context ):
+	""" Report the duration of a phase """
+	if not enabled:
+		return
+	entry = dict( context, phase=phase, seconds=round( seconds, 6 ),
+		time=round( time.time(), 3 ), thread=thread.get_ident() )
+	line = json.dumps( entry, sort_keys=True )
+	lock.acquire()
+	try:
+		print 'P: ' + line
+		if fileName:
+			f = open( fileName, 'a' )
+			f.write( line + '\n' )
+			f.close()
+	finally:
+		lock.release()
+
+
+class timed:
+	""" Time the block of a with statement as a phase: with timed( 'extent', layer=name ): """
+	def __init__( self, phase, **context ):
+		self.phase = phase
+		self.context = context
+
+	def __enter__( self ):
+		self.start = time.time()
+		return self
+
+	def __exit__( self, excType, excValue, traceback ):
+		if excType is not None:
+			self.context['failed'] = True
+		record( self.phase, time.time() - self.start, **self.context )
+		return False
@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+"""
+Headless batch rendering of postgis_viewer (--render=dir): every layer of the
+request is rendered to a PNG file, without a window, by a pool of processes.
+Each worker process initializes QGIS once and keeps its database connections
+for all the layers it renders. The launcher process only loads QtCore and
+QtNetwork (postgis_viewer_ipc), neither QtGui nor QGIS: the layers are
+detected by a worker too, and their detected metadata is handed to the
+workers rendering them.
+"""
+
+import os, sys, time
+import multiprocessing
+
+# Layers rendered by a worker process before it is replaced, bounding the
+# memory the QGIS providers may keep
+max_tasks_per_worker = 500
+
+gui = None # postgis_viewer_gui, imported by each worker
+app = None
+
+def initWorker():
+	""" Load Qt and QGIS in a worker process """
+	global gui, app
+	import postgis_viewer_gui
+	gui = postgis_viewer_gui
+	from PyQt4.QtGui import QApplication
+	app = QApplication( sys.argv, False ) # No display needed
+	gui.QgsApplication.setPrefixPath( gui.qgis_prefix, True )
+	gui.QgsApplication.initQgis()
+
+def detectLayers( dictOpts ):
+	""" Return ( a copy of dictOpts, metadata ) per layer of the request, None if
+		the connection failed """
+	d = gui.openConnection( dictOpts )
+	if not d.isOpen():
+		return None
+	return [ ( layerOpts, gui.layerMetadataCache.get( layerOpts ) )
+		for layerOpts in gui.expandRequest( d, dictOpts ) ]
+
+def renderLayer( task ):
+	""" Render a layer to a PNG file, return ( layer name, file or None, error ) """
+	from PyQt4.QtCore import QSize, Qt
+	from PyQt4.QtGui import QImage, QPainter, QColor
+	from qgis.core import QgsMapRenderer, QgsMapLayerRegistry, QgsRectangle
+
+	layerOpts, metadata, outputDir, width, height, extent = task
+	name = layerOpts['-s'] + '.' + layerOpts['-t']
+	if metadata is not None and gui.layerMetadataCache.get( layerOpts ) is None:
+		gui.layerMetadataCache.put( layerOpts, metadata ) # Detected by another worker
+	try:
+		layer = gui.createLayer( layerOpts )
+		if not layer.isValid():
+			return ( name, None, 'Layer is not valid' )
+		QgsMapLayerRegistry.instance().addMapLayer( layer, False )
+		try:
+			if extent is None:
+				rect = gui.layerExtent( layer, layerOpts )
+				rect.scale( 1.05 )
+			else:
+				rect = QgsRectangle( *extent )
+
+			image = QImage( QSize( width, height ), QImage.Format_ARGB32_Premultiplied )
+			image.fill( QColor( Qt.white ).rgb() ) # A uint before Qt 4.8
+			renderer = QgsMapRenderer()
+			renderer.setLayerSet( [ layer.getLayerID() ] )
+			renderer.setMapUnits( layer.srs().mapUnits() )
+			renderer.setOutputSize( image.size(), image.logicalDpiX() )
+			renderer.setExtent( rect )
+
+			painter = QPainter()
+			painter.begin( image )
+			painter.setRenderHint( QPainter.Antialiasing )
+			renderer.render( painter )
+			painter.end()
+
+			fileName = os.path.join( outputDir, name + '.png' )
+			if not image.save( fileName, 'PNG' ):
+				return ( name, None, 'Could not write ' + fileName )
+			return ( name, fileName, None )
+		finally:
+			QgsMapLayerRegistry.instance().removeMapLayer( layer.getLayerID() )
+	except Exception, e:
+		return ( name, None, str( e ) )
+
+def parseSize( text ):
+	""" Return ( width, height ) of a WIDTHxHEIGHT text """
+	width, height = text.lower().split( 'x' )
+	return int( width ), int( height )
+
+def parseExtent( text ):
+	""" Return ( xmin, ymin, xmax, ymax ) of a comma separated text, None if empty """
+	if not text:
+		return None
+	return tuple( [ float( value ) for value in text.split( ',' ) ] )
+
+def main( dictOpts, report ):
+	""" Render the layers of a request, exit with 1 if any of them failed """
+	outputDir = dictOpts['--render']
+	width, height = parseSize( dictOpts['--size'] )
+	extent = parseExtent( dictOpts['--extent'] )
+	workers = int( dictOpts['--workers'] or multiprocessing.cpu_count() )
+	if not os.path.isdir( outputDir ):
+		os.makedirs( outputDir )
+
+	pool = multiprocessing.Pool( workers, initWorker, maxtasksperchild=max_tasks_per_worker )
+	layers = pool.apply( detectLayers, ( dictOpts, ) )
+	report.phase( 'detection' )
+	if layers is None:
+		print >> sys.stderr, 'E: Error when connecting to database.'
+		sys.exit( 1 )
+	if not layers:
+		print >> sys.stderr, "E: Layer '%s.%s' doesn't exist." % ( dictOpts['-s'], dictOpts['-t'] )
+		sys.exit( 1 )
+
+	print 'I: Rendering %d layers with %d workers ...' % ( len( layers ), workers )
+	start = time.time()
+	failed = 0
+	tasks = [ ( layerOpts, metadata, outputDir, width, height, extent ) for layerOpts, metadata in layers ]
+	for name, fileName, error in pool.imap_unordered( renderLayer, tasks ):
+		if error is None:
+			print 'I: %s rendered to %s' % ( name, fileName )
+		else:
+			print >> sys.stderr, 'E: %s not rendered: %s' % ( name, error )
+			failed += 1
+	pool.close()
+	pool.join()
+
+	report.phase( 'rendering' )
+	print 'I: %d layers rendered in %.1f s, %d failed' % ( len( layers ) - failed, time.time() - start, failed )
+	if failed:
+		sys.exit( 1 )